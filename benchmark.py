@@ -0,0 +1,489 @@
+#region Imports
+import os
+import sys
+import json
+import time
+import random
+import shlex
+import hashlib
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+
+import xlsxwriter
+
+import confronto_inventario_per_data_ts as app
+# endregion
+
+# region Configurazione
+# Scale dei benchmark: numero di righe di inventario_completo (e circa altrettante righe TS)
+scales = {'10k': 10_000, '1m': 1_000_000, '10m': 10_000_000}
+deps = ('00', 'FE')
+xlsx_max_rows = 1_000_000  # Un foglio Excel non supera 1.048.576 righe
+# Avvio dello script: import (python -X importtime) e confronto solo locale, senza moduli pesanti
+import_budget_ms = 300
+startup_budget_s = 1.0
+startup_budget_scale = '10k'  # Il confronto locale esporta tutte le righe: il budget di tempo vale sul database piccolo
+heavy_modules = ('pandas', 'numpy', 'pyarrow', 'mariadb', 'sshtunnel', 'paramiko', 'tqdm', 'tabulate', 'dotenv')
+# Controlli che fanno fallire il benchmark (codice di uscita 1, dopo aver salvato i risultati)
+checks = ('parita_snapshot', 'parita_motori', 'parita_cache', 'budget_avvio_rispettato')
+
+parser = argparse.ArgumentParser(description="Benchmark offline di importazione e confronto inventario.")
+parser.add_argument('--scale', choices=scales.keys(), default='10k', help="Dimensione dei dati sintetici (default 10k).")
+parser.add_argument('--sedi', type=int, default=3, help="Numero di sedi generate (default 3).")
+parser.add_argument('--days', type=int, default=5, help="Giorni di inventario generati (default 5).")
+parser.add_argument('--seed', type=int, default=42)
+parser.add_argument('--workdir', help="Cartella di lavoro (default: cartella temporanea eliminata alla fine).")
+parser.add_argument('--output', help="File JSON dei risultati (default bench_results/<scala>-<commit>.json).")
+parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Processi per la lettura Excel.")
+# Uso interno: sostituto del client mysql per lo snapshot di Odin (vedi use_local_odin)
+parser.add_argument('--mysql-batch', metavar='DB', help=argparse.SUPPRESS)
+parser.add_argument('--execute', help=argparse.SUPPRESS)
+# endregion
+
+
+# region Odin locale
+# Sostituto di Odin: un database SQLite con le stesse tabelle e colonne usate dalle query dello script.
+# Le colonne TIMESTAMP tornano come datetime, come con il connettore MariaDB.
+class LocalOdinConnection:
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES)
+
+    def cursor(self, buffered=True):
+        return self.conn.cursor()
+
+    def ping(self):
+        self.conn.execute("SELECT 1;")
+
+    def close(self):
+        self.conn.close()
+
+
+class LocalOdinTunnel:
+    local_bind_host = '127.0.0.1'
+    local_bind_port = 0
+    is_active = True
+
+    def restart(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def print_mysql_batch(path, query):
+    # Come mysql --batch --skip-column-names: righe separate da tab, NULL come testo, NUL, tab, a capo e
+    # backslash dei valori con escape
+    escapes = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\0': '\\0'})
+    conn = sqlite3.connect(path)
+    out = sys.stdout
+    for row in conn.execute(query):
+        out.write("\t".join('NULL' if v is None else str(v).translate(escapes) for v in row) + "\n")
+    conn.close()
+
+
+def run_local_command(command, stdin=b''):
+    # Come run_odin_command, con il comando eseguito in locale
+    process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    process.stdin.write(stdin)
+    process.stdin.close()
+    return process.stdout, lambda: (process.wait(), process.stderr.read())
+
+
+def use_local_odin(path):
+    # Sostituisce connect_db_odin/open_odin_connection dello script con il database locale; lo snapshot esegue
+    # in locale questo script come client mysql sul database locale
+    app.connect_db_odin = lambda: (LocalOdinTunnel(), LocalOdinConnection(path))
+    app.open_odin_connection = lambda tunnel: LocalOdinConnection(path)
+    app.run_odin_command = run_local_command
+    app.odin_snapshot_command = " ".join(shlex.quote(arg) for arg in (
+        sys.executable, os.path.abspath(__file__), '--mysql-batch', path)) + " --execute={query} | gzip -1"
+    app.tunnel_odin, app.conn_odin = app.connect_db_odin()
+    app.cursor_odin = app.conn_odin.cursor()
+# endregion
+
+
+# region Dati sintetici
+def sku_code(i):
+    return "SKU{:07d}".format(i)
+
+
+def generate_odin(path, rows, skus, sedi, days, rnd):
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE prodotti (id INTEGER PRIMARY KEY, cod TEXT, old_cod TEXT, uf_cod TEXT, descrizione TEXT);
+        CREATE TABLE sedi (id INTEGER PRIMARY KEY, nome TEXT);
+        CREATE TABLE users (id INTEGER PRIMARY KEY, username TEXT);
+        CREATE TABLE inventario_completo (
+            id INTEGER PRIMARY KEY, id_prod INTEGER, qta INTEGER, luogo TEXT, sezione INTEGER, id_sede INTEGER,
+            data_creazione TIMESTAMP, ultima_modifica TIMESTAMP, note TEXT, id_user INTEGER);
+    """)
+    # Un prodotto su 50 ha solo il vecchio codice
+    conn.executemany("INSERT INTO prodotti VALUES (?,?,?,?,?);", (
+        (i, None if i % 50 == 0 else sku_code(i), "OLD{:07d}".format(i), "UF{}".format(i),
+         "Prodotto sintetico numero {}".format(i)) for i in range(1, skus + 1)))
+    conn.executemany("INSERT INTO sedi VALUES (?,?);", [(i, name) for i, name in enumerate(sedi, start=1)])
+    conn.executemany("INSERT INTO users VALUES (?,?);", [(i, "operatore{}".format(i)) for i in range(1, 21)])
+
+    def inventory():
+        for i in range(1, rows + 1):
+            day = rnd.choice(days)
+            created = datetime(day.year, day.month, day.day, rnd.randint(7, 19), rnd.randint(0, 59))
+            yield (i, rnd.randint(1, skus), rnd.randint(0, 50), "L{}".format(rnd.randint(1, 200)), rnd.randint(1, 9),
+                   rnd.randint(1, len(sedi)), created, created, None if i % 7 else "nota" if i % 700 else "nota\tcon\\escape\n",
+                   rnd.randint(1, 20))
+    conn.executemany("INSERT INTO inventario_completo VALUES (?,?,?,?,?,?,?,?,?,?);", inventory())
+    conn.commit()
+    conn.close()
+
+
+def write_xlsx(filename, header, rows):
+    workbook = xlsxwriter.Workbook(filename, {'constant_memory': True})
+    worksheet = workbook.add_worksheet()
+    worksheet.write_row(0, 0, header)
+    for row_num, row in enumerate(rows, start=1):
+        worksheet.write_row(row_num, 0, row)
+    workbook.close()
+
+
+def generate_ts_files(directory, skus, days, rnd):
+    # Un file per giorno (diviso in più file se supera il limite di righe di Excel)
+    os.makedirs(directory, exist_ok=True)
+    rows_per_day = skus * len(deps)
+    parts = -(-rows_per_day // xlsx_max_rows)
+    for day in days:
+        for part in range(parts):
+            first, last = part * xlsx_max_rows, min(rows_per_day, (part + 1) * xlsx_max_rows)
+            code = lambda i: sku_code(i) if i % 50 else "OLD{:07d}".format(i)
+            rows = ((code(n // len(deps) + 1), "Prodotto", rnd.randint(0, 100), deps[n % len(deps)])
+                    for n in range(first, last))
+            suffix = " parte {}".format(part + 1) if parts > 1 else ""
+            write_xlsx(os.path.join(directory, "Giacenze {}{}.xlsx".format(day.strftime('%d-%m-%Y'), suffix)),
+                       ("Codice articolo", "Descrizione", "Giac.att.1", "Dep"), rows)
+
+
+def generate_corrected_file(directory, odin_path, fraction, rnd):
+    # Un file di correzioni con una frazione delle rilevazioni segnate come corrette, nel formato dei report
+    # esportati (con id_odin)
+    os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(odin_path)
+    rows = conn.execute("""
+        SELECT ic.id, IFNULL(cod, old_cod), luogo, sezione, s.nome, u.username
+        FROM inventario_completo ic
+        JOIN prodotti p ON p.id = ic.id_prod
+        JOIN sedi s ON s.id = ic.id_sede
+        JOIN users u ON u.id = ic.id_user
+        WHERE ic.id % ? = 0;
+    """, (max(1, int(1 / fraction)),))
+    write_xlsx(os.path.join(directory, "Confronto corretto.xlsx"),
+               ("Corretto", "id_odin", "sku", "luogo", "sez", "sede", "operatore"),
+               ((1 if rnd.random() < 0.9 else None,) + tuple(row) for row in rows))
+    conn.close()
+
+
+def generate_dataset(workdir, rows, n_sedi, n_days, seed):
+    rnd = random.Random(seed)
+    skus = max(100, rows // (len(deps) * n_days))
+    sedi = ["Rende"] + ["Sede {}".format(i) for i in range(2, n_sedi + 1)]
+    days = [datetime(2024, 11, 1).date() + timedelta(days=d) for d in range(n_days)]
+    odin_path = os.path.join(workdir, 'odin.db')
+    generate_odin(odin_path, rows, skus, sedi, days, rnd)
+    generate_ts_files(os.path.join(workdir, 'db_files'), skus, days, rnd)
+    generate_corrected_file(os.path.join(workdir, 'corrected_files'), odin_path, 0.01, rnd)
+    return odin_path
+# endregion
+
+
+# region Scenari
+results = {}
+
+
+def record(name, seconds, rows):
+    results[name] = {'secondi': round(seconds, 4), 'righe': rows,
+                     'righe_al_secondo': round(rows / seconds) if rows and seconds else None}
+    print("{:<28} {:>10.3f}s {:>12} righe".format(name, seconds, rows if rows is not None else '-'))
+
+
+def measure(name, function, count=len, rows=None):
+    # Esegue function() e registra durata e righe (rows, oppure count applicato al risultato)
+    started = time.perf_counter()
+    value = function()
+    record(name, time.perf_counter() - started, rows if rows is not None else count(value))
+    return value
+
+
+def rows_digest(rows):
+    # Digest indipendente dall'ordine delle righe (somma degli sha256 delle righe, modulo 2**256), numero di righe
+    # e secondi passati a leggerle (senza il calcolo del digest): i risultati dei motori si confrontano senza
+    # tenerli in memoria. I float interi diventano int, come per il confronto con == tra valori Python.
+    total, count, seconds = 0, 0, 0.0
+    rows = iter(rows)
+    while True:
+        started = time.perf_counter()
+        row = next(rows, None)
+        seconds += time.perf_counter() - started
+        if row is None:
+            break
+        row = tuple(int(value) if isinstance(value, float) and value.is_integer() else value for value in row)
+        total += int.from_bytes(hashlib.sha256(repr(row).encode()).digest(), 'big')
+        count += 1
+    return total % 2 ** 256, count, seconds
+
+
+def measure_discrepancy(name):
+    # Confronto letto in streaming (app.iter_discrepancy, come l'esportazione) con il motore e la cache di app.args
+    digest, rows, seconds = rows_digest(app.iter_discrepancy())
+    record(name, seconds, rows)
+    return digest, rows
+
+
+def measure_xlsx_import(paths, table, import_function):
+    # Lettura e importazione file per file: ogni DataFrame viene rilasciato prima di leggere il successivo.
+    # Con --workers > 1 la lettura dei file successivi prosegue durante l'importazione: parse_xlsx_* misura
+    # l'attesa dei file letti.
+    parse_seconds, import_seconds, rows = 0.0, 0.0, 0
+    frames = app.parse_xlsx_files(paths, table)
+    while True:
+        started = time.perf_counter()
+        item = next(frames, None)
+        parse_seconds += time.perf_counter() - started
+        if item is None:
+            break
+        started = time.perf_counter()
+        import_function(item[1])
+        import_seconds += time.perf_counter() - started
+        rows += len(item[1])
+        del item
+    record('parse_xlsx_' + table, parse_seconds, rows)
+    record(import_function.__name__, import_seconds, rows)
+
+
+def odin_digest(mode):
+    # sha256 e numero delle righe scaricate da Odin nella forma in cui vengono scritte su SQLite, e secondi
+    # passati a scaricarle (senza il calcolo del digest)
+    sha, rows, seconds = hashlib.sha256(), 0, 0.0
+    batches = app.get_odin_inventario_completo_as_df(app.args.odin_batch_size, mode)
+    while True:
+        started = time.perf_counter()
+        batch = next(batches, None)
+        seconds += time.perf_counter() - started
+        if batch is None:
+            break
+        for row in app.to_sqlite_rows(batch, batch.columns, datetime_columns=('data', 'ultima_modifica')):
+            sha.update(repr(tuple(row)).encode())
+        rows += len(batch)
+    return sha.hexdigest(), rows, seconds
+
+
+def setup_app(workdir, odin_path):
+    app.args.workers = args.workers
+    app.dir_ts_file_by_date = os.path.join(workdir, 'db_files')
+    app.dir_corrected_file = os.path.join(workdir, 'corrected_files')
+    app.dir_parse_cache = os.path.join(workdir, 'cache_xlsx')
+    app.dir_result_cache = os.path.join(workdir, 'cache_confronto')
+    app.args.result_cache_entries = 0  # I motori si misurano senza cache dei risultati (misurata a parte)
+    app.database = os.path.join(workdir, 'inventario.db')
+    if os.path.exists(app.database):
+        os.remove(app.database)
+    app.conn_app = sqlite3.connect(app.database)
+    app.cursor_app = app.conn_app.cursor()
+    app.apply_app_pragmas()
+    app.init_app_db()
+    use_local_odin(odin_path)
+
+
+def run_scenarios(workdir, odin_path):
+    setup_app(workdir, odin_path)
+    ts_paths = sorted(os.path.join(app.dir_ts_file_by_date, f) for f in os.listdir(app.dir_ts_file_by_date))
+    corrected_paths = [os.path.join(app.dir_corrected_file, f) for f in os.listdir(app.dir_corrected_file)]
+
+    measure_xlsx_import(ts_paths, 'ts', app.import_df_in_ts_by_date)
+
+    # Scaricamento e importazione Odin: il tempo di importazione viene separato da quello di rete
+    app.total_rows_odin = app.get_odin_inventario_completo_total_rows()
+    fetch_seconds, import_seconds, rows = 0.0, 0.0, 0
+    started = time.perf_counter()
+    app.begin_odin_bulk_load()  # Come la sincronizzazione completa: totali del confronto ricalcolati a fine caricamento
+    import_seconds += time.perf_counter() - started
+    started = time.perf_counter()
+    for batch in app.get_odin_inventario_completo_as_df(app.args.odin_batch_size, 'keyset'):
+        fetch_seconds += time.perf_counter() - started
+        started = time.perf_counter()
+        app.import_df_in_odin_by_date(batch, progress=False)
+        import_seconds += time.perf_counter() - started
+        rows += len(batch)
+        started = time.perf_counter()
+    fetch_seconds += time.perf_counter() - started
+    started = time.perf_counter()
+    app.end_odin_bulk_load()
+    import_seconds += time.perf_counter() - started
+    record('odin_fetch', fetch_seconds, rows)
+    record('import_df_in_odin_by_date', import_seconds, rows)
+
+    # Snapshot compresso (--odin-fetch snapshot): solo trasferimento e lettura, con le stesse righe del keyset
+    # (parita_snapshot) e i byte trasferiti rispetto al TSV non compresso
+    digest, rows, seconds = odin_digest('snapshot')
+    record('odin_fetch_snapshot', seconds, rows)
+    results['parita_snapshot'] = (digest, rows) == odin_digest('keyset')[:2]
+    snapshot_metrics = app.metrics['fasi']['snapshot_odin']
+    results['snapshot_mb'] = round(snapshot_metrics['mb_trasferiti'], 2)
+    results['snapshot_mb_non_compressi'] = round(snapshot_metrics['mb_non_compressi'], 2)
+    if not results['parita_snapshot']:
+        print("ATTENZIONE: lo snapshot di Odin è diverso dallo scaricamento keyset.")
+
+    measure('transfer_products_meta', app.transfer_missing_products_meta_to_local_db,
+            rows=len(app.get_missing_products_meta_skus()))
+
+    measure_xlsx_import(corrected_paths, 'corrected', app.import_df_in_corrected)
+
+    # Parità tra i motori del confronto: stesse righe (in qualunque ordine), confrontate con rows_digest
+    app.args.engine = 'sql'
+    expected = measure_discrepancy('calc_discrepancy')
+    results['parita_motori'] = True
+    app.args.engine = 'vectorized'
+    results['parita_motori'] &= measure_discrepancy('calc_discrepancy_vectorized') == expected
+    # Parallelo: intervalli di SKU su --workers processi, accelerazione rispetto alla query sql su un solo core
+    app.args.engine = 'parallel'
+    results['parita_motori'] &= measure_discrepancy('calc_discrepancy_parallel') == expected
+    results['accelerazione_parallelo'] = round(
+        results['calc_discrepancy']['secondi'] / results['calc_discrepancy_parallel']['secondi'], 2)
+    # Materializzato: primo calcolo completo (tutti gli SKU sono nuovi), poi lettura della tabella
+    app.args.engine = 'materialized'
+    measure('refresh_discrepancy', app.refresh_discrepancy, count=lambda skus: skus)
+    results['parita_motori'] &= measure_discrepancy('calc_discrepancy_materialized') == expected
+
+    # Aggiornamento incrementale dopo una piccola modifica: 100 giacenze TS cambiate
+    app.cursor_app.execute("UPDATE ts_by_date SET qta = qta + 1 WHERE (sku_id, giorno, dep_id) IN "
+                           "(SELECT sku_id, giorno, dep_id FROM ts_by_date LIMIT 100);")
+    app.conn_app.commit()
+    measure('refresh_discrepancy_delta', app.refresh_discrepancy, count=lambda skus: skus)
+    materialized = rows_digest(app.iter_discrepancy())[:2]
+    app.args.engine = 'sql'
+    results['parita_motori'] &= materialized == rows_digest(app.iter_discrepancy())[:2]
+    if not results['parita_motori']:
+        print("ATTENZIONE: i motori sql, vectorized, parallel e materialized danno risultati diversi.")
+
+    # Cache dei risultati: primo confronto calcolato e scritto in cache, il secondo letto dalla cache;
+    # dopo una modifica la voce non deve più essere usata
+    app.args.result_cache_entries = 8
+    measure_discrepancy('calc_discrepancy_cache_scrittura')
+    results['parita_cache'] = measure_discrepancy('calc_discrepancy_cache') == materialized
+    app.cursor_app.execute("UPDATE ts_by_date SET qta = qta + 1 WHERE (sku_id, giorno, dep_id) IN "
+                           "(SELECT sku_id, giorno, dep_id FROM ts_by_date LIMIT 100);")
+    app.conn_app.commit()
+    cached = rows_digest(app.iter_discrepancy())[:2]
+    app.args.result_cache_entries = 0
+    results['parita_cache'] &= cached == rows_digest(app.iter_discrepancy())[:2]
+    if not results['parita_cache']:
+        print("ATTENZIONE: il confronto letto dalla cache è diverso da quello calcolato.")
+    export_dir = os.path.join(workdir, 'export')
+    os.makedirs(export_dir, exist_ok=True)
+    measure('export_as_excel',
+            lambda: app.export_as_excel(app.iter_discrepancy(), os.path.join(export_dir, 'benchmark.xlsx')),
+            rows=cached[1])
+
+    app.conn_app.close()
+    app.conn_odin.close()
+    results['dimensione_db_mb'] = round(os.path.getsize(app.database) / 1024 / 1024, 2)
+# endregion
+
+
+# region Avvio
+def get_imported_modules(stderr):
+    # Moduli di primo livello e tempo cumulativo (µs) per modulo dall'output di python -X importtime
+    imported = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        if cumulative.strip().isdigit():  # Salta l'intestazione
+            imported[name.strip()] = int(cumulative)
+    return imported
+
+
+def measure_startup(workdir):
+    # Import dello script misurato con -X importtime in un processo nuovo, poi un confronto solo locale
+    # (nessuna importazione, esportazione CSV, senza cache dei risultati) sul database del benchmark, che non deve
+    # contattare Odin né caricare moduli pesanti nemmeno sul percorso di confronto ed esportazione
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import confronto_inventario_per_data_ts'],
+                            cwd=script_dir, capture_output=True, text=True, check=True).stderr
+    imported = get_imported_modules(stderr)
+    import_us = imported['confronto_inventario_per_data_ts']
+    results['import_ms'] = round(import_us / 1000, 1)
+    results['import_moduli_pesanti'] = sorted({name.split('.')[0] for name in imported}.intersection(heavy_modules))
+    print("{:<28} {:>10.3f}s {}".format('import', import_us / 1e6, ", ".join(results['import_moduli_pesanti'])))
+
+    started = time.perf_counter()
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', os.path.join(script_dir, 'confronto_inventario_per_data_ts.py'),
+                             '--skip-ts', '--skip-odin', '--skip-prod-meta', '--skip-corrected',
+                             '--export', '--export-format', 'csv', '--result-cache-entries', '0'],
+                            cwd=workdir, capture_output=True, text=True, check=True).stderr
+    record('avvio_locale', time.perf_counter() - started, None)
+    results['avvio_moduli_pesanti'] = sorted({name.split('.')[0] for name in get_imported_modules(stderr)}
+                                             .intersection(heavy_modules))
+
+    results['budget_avvio_rispettato'] = (results['import_ms'] <= import_budget_ms
+                                          and not results['import_moduli_pesanti']
+                                          and not results['avvio_moduli_pesanti']
+                                          and (args.scale != startup_budget_scale
+                                               or results['avvio_locale']['secondi'] <= startup_budget_s))
+    if not results['budget_avvio_rispettato']:
+        print("ATTENZIONE: avvio oltre il budget ({} ms di import, {} s di esecuzione locale sulla scala {}, "
+              "senza {}).".format(import_budget_ms, startup_budget_s, startup_budget_scale, ", ".join(heavy_modules)))
+# endregion
+
+
+# region Esecuzione
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'sconosciuto'
+
+
+def main():
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bench_inventario_')
+    os.makedirs(workdir, exist_ok=True)
+    rows = scales[args.scale]
+    try:
+        print("Genero dati sintetici ({} righe, {} sedi, {} giorni) in {}...".format(rows, args.sedi, args.days, workdir))
+        started = time.perf_counter()
+        odin_path = generate_dataset(workdir, rows, args.sedi, args.days, args.seed)
+        print("Dati generati in {:.1f}s.".format(time.perf_counter() - started))
+        run_scenarios(workdir, odin_path)
+        measure_startup(workdir)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    commit = get_commit()
+    report = {'commit': commit, 'data': datetime.now().isoformat(timespec='seconds'), 'scala': args.scale,
+              'righe': rows, 'sedi': args.sedi, 'giorni': args.days, 'workers': args.workers, 'core': os.cpu_count(),
+              'python': sys.version.split()[0],
+              'sqlite': sqlite3.sqlite_version, 'risultati': results}
+    output = args.output or os.path.join('bench_results', "{}-{}.json".format(args.scale, commit))
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Risultati salvati in {}.".format(output))
+    failed = [check for check in checks if results.get(check) is not True]
+    if failed:
+        print("ERRORE: controlli non superati: {}.".format(", ".join(failed)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.mysql_batch:
+        print_mysql_batch(args.mysql_batch, args.execute)
+    else:
+        main()
+# endregion
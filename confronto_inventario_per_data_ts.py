@@ -1,15 +1,45 @@
 #region Imports
-import pandas as pd
 import sqlite3
-import mariadb
 import os
-from tabulate import tabulate
-from tqdm import tqdm
-from dotenv import load_dotenv
+import sys
 import re
+import csv
+import gzip
+import shlex
+import json
+import itertools
+import time
+import queue
+import hashlib
 import argparse
-from datetime import datetime
-from sshtunnel import SSHTunnelForwarder
+import threading
+import functools
+import multiprocessing
+import importlib
+import importlib.util
+import tracemalloc
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class LazyModule:
+    # Modulo importato al primo accesso a un attributo: pandas e mariadb costano centinaia di ms all'avvio
+    # e un confronto solo locale con esportazione in streaming non li usa
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self._name), attr)
+
+
+pd = LazyModule('pandas')
+mariadb = LazyModule('mariadb')
+
+
+def tqdm(*args_, **kwargs):
+    from tqdm import tqdm as progress_bar
+    return progress_bar(*args_, **kwargs)
 # endregion
 
 # region Configurazione
@@ -18,6 +48,36 @@ dir_ts_file_by_date = 'db_files'  # Directory contenente i file Excel (nella roo
 # dir_odin_file = 'db_odin'
 dir_corrected_file = 'corrected_files'
 excel_export_path = 'export'
+dir_parse_cache = 'cache_xlsx'  # Cache dei file Excel già letti (sopravvive a --reset)
+parse_cache_version = 2  # Da incrementare a ogni modifica dei DataFrame restituiti da get_xlsx_as_df
+dir_result_cache = 'cache_confronto'  # Risultati del confronto già calcolati (vedi region Cache confronto)
+# Colonne lette dai file Excel (le altre non vengono nemmeno decodificate)
+xlsx_columns = {
+    'ts': ["Codice articolo", "Giac.att.1", "Dep"],
+    'corrected': ["Corretto", "id_odin", "sku", "luogo", "sez", "sede", "operatore"],
+}
+# Colonne che possono mancare: i file di correzioni esportati prima della colonna id_odin non la hanno
+xlsx_optional_columns = {
+    'corrected': ["id_odin"],
+}
+schema_version = 12  # Da incrementare a ogni modifica dello schema di inventario.db (PRAGMA user_version)
+deposito_default = 'FE'  # Deposito TS delle sedi non presenti in sedi_depositi
+sedi_depositi = {'Rende': '00'}  # Mappatura iniziale sede Odin -> deposito TS
+# Comando eseguito sul server SSH di Odin per lo snapshot (--odin-fetch snapshot), sostituibile con
+# ODIN_SNAPSHOT_COMMAND nell'.env: deve scrivere su stdout l'output di mysql --batch compresso con gzip.
+# La password arriva su stdin come file di opzioni, così non compare tra gli argomenti dei processi.
+odin_snapshot_command = ("mysql --defaults-extra-file=/dev/stdin --batch --quick --skip-column-names "
+                         "--host={host} --port={port} --user={user} --database={database} --execute={query} "
+                         "| gzip -1")
+
+
+
+def parse_date_arg(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise argparse.ArgumentTypeError("data non valida '{}', formato AAAA-MM-GG".format(value))
+
 
 parser = argparse.ArgumentParser(description="Script di importazione e confronto inventario.")
 parser.add_argument('-r', '--reset', action='store_true', help="Resetta il database eliminando i dati esistenti.")
@@ -27,11 +87,351 @@ parser.add_argument('--skip-odin', action='store_true', help="Salta importazione
 parser.add_argument('--skip-prod-meta', action='store_true', help="Salta importazione Meta Prodotti.")
 parser.add_argument('--skip-corrected', action='store_true', help="Salta importazione giacenze corrette.")
 parser.add_argument('--print-results','-p', action='store_true', help="Stampa risultati nella console.")
-args = parser.parse_args()
-load_dotenv()  # Carica i segreti dall'.env
+parser.add_argument('--export-format', choices=('xlsx', 'csv', 'parquet'), default='xlsx',
+                    help="Formato del file di esportazione del confronto (default xlsx).")
+parser.add_argument('--split-sede', action='store_true', help="Esporta un file per ogni sede.")
+export_group = parser.add_mutually_exclusive_group()
+export_group.add_argument('--export', dest='export', action='store_true', default=None,
+                          help="Esporta il confronto senza chiedere conferma.")
+export_group.add_argument('--no-export', dest='export', action='store_false',
+                          help="Non esporta il confronto e non chiede conferma.")
+parser.add_argument('--from', dest='date_from', type=parse_date_arg, metavar='AAAA-MM-GG',
+                    help="Scarica e confronta solo le rilevazioni da questa data (inclusa).")
+parser.add_argument('--to', dest='date_to', type=parse_date_arg, metavar='AAAA-MM-GG',
+                    help="Scarica e confronta solo le rilevazioni fino a questa data (inclusa).")
+parser.add_argument('--sede', action='append', help="Scarica e confronta solo questa sede Odin (ripetibile).")
+parser.add_argument('--deposito', action='append', help="Confronta solo questo deposito TS (ripetibile).")
+parser.add_argument('--as-of', dest='as_of', type=parse_date_arg, metavar='AAAA-MM-GG',
+                    help="Confronta lo stato delle rilevazioni a questa data (storico in odin_storico).")
+parser.add_argument('--retention-days', type=int, default=0,
+                    help="Nello storico delle rilevazioni compatta i giorni più vecchi di N giorni (default 0 = mai).")
+parser.add_argument('--daemon', action='store_true',
+                    help="Resta in esecuzione con tunnel e connessioni aperte, confronto a intervalli o su richiesta HTTP.")
+parser.add_argument('--daemon-interval', type=int, default=0,
+                    help="In modalità --daemon esegue importazione e confronto ogni N minuti (0 = solo su richiesta).")
+parser.add_argument('--daemon-port', type=int, default=8765,
+                    help="Porta locale (127.0.0.1) dell'API della modalità --daemon (default 8765).")
+parser.add_argument('--explain', action='store_true', help="Stampa il piano di esecuzione delle query di confronto ed esce con errore se contiene scansioni complete.")
+parser.add_argument('--engine', choices=('materialized', 'sql', 'vectorized', 'parallel'), default='materialized',
+                    help="Motore del confronto: tabella discrepanze aggiornata per SKU modificati (default), "
+                         "query SQLite completa (sql), pandas in memoria (vectorized) o query SQLite divisa per "
+                         "intervalli di SKU su --workers processi (parallel).")
+parser.add_argument('--rebuild-discrepancy', action='store_true',
+                    help="Ricostruisce da zero la tabella discrepanze e i totali rilevati.")
+parser.add_argument('--odin-batch-size', type=int, default=10000, help="Righe per blocco scaricate da Odin (default 10000).")
+parser.add_argument('--odin-fetch', choices=('keyset', 'stream', 'snapshot'), default='keyset',
+                    help="Modalità di scaricamento completo da Odin: keyset su ic.id (default), cursore non "
+                         "bufferizzato o snapshot compresso prodotto sul server e trasferito via SSH.")
+parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                    help="Processi usati per leggere i file Excel in parallelo e per il confronto con --engine parallel "
+                         "(default: numero di core, 1 = seriale).")
+parser.add_argument('--excel-engine', choices=('auto', 'calamine', 'openpyxl'), default='auto',
+                    help="Motore di lettura Excel (auto: calamine se installato, altrimenti openpyxl).")
+parser.add_argument('--no-cache', action='store_true', help="Non usa la cache dei file Excel già letti.")
+parser.add_argument('--cache-max-mb', type=int, default=512,
+                    help="Dimensione massima della cache dei file Excel in MB (default 512).")
+parser.add_argument('--result-cache-entries', type=int, default=8,
+                    help="Risultati del confronto tenuti in cache per versione dei dati e filtri (default 8, 0 = nessuna cache).")
+parser.add_argument('--sequential', action='store_true',
+                    help="Esegue le fasi di importazione una alla volta invece che in parallelo.")
+parser.add_argument('--fast-load', action='store_true',
+                    help="Durante l'importazione usa WAL, synchronous=OFF e una cache SQLite più grande.")
+parser.add_argument('--stage-threshold', type=int, default=500000,
+                    help="Oltre questo numero di righe l'importazione passa da una tabella temporanea (0 = mai).")
+parser.add_argument('--meta-batch-size', type=int, default=1000, help="SKU per richiesta di meta prodotti a Odin (default 1000).")
+parser.add_argument('--meta-workers', type=int, default=4,
+                    help="Connessioni Odin usate in parallelo per i meta prodotti (default 4).")
+parser.add_argument('--meta-refresh-days', type=int, default=30,
+                    help="Riscarica i meta prodotti controllati più di N giorni fa (default 30, 0 = mai).")
+parser.add_argument('--odin-sync', choices=('incremental', 'full'), default='incremental',
+                    help="incremental: scarica solo le righe modificate dall'ultima sincronizzazione (default). "
+                         "full: riscarica tutto inventario_completo.")
+parser.add_argument('--metrics-json', metavar='FILE',
+                    help="Salva a fine esecuzione tempi, righe e memoria di ogni fase e di ogni istruzione SQL in FILE.")
+parser.add_argument('--profile', metavar='FILE',
+                    help="Profila l'esecuzione (thread principale) con cProfile e salva le statistiche in FILE.")
+parser.add_argument('--tracemalloc', action='store_true',
+                    help="Traccia le allocazioni con tracemalloc: picco di memoria Python per fase (più lento).")
+# Gli argomenti si leggono solo quando il file è eseguito come script (o nei processi spawn del pool);
+# importato come modulo (es. benchmark.py) usa i valori di default
+args = parser.parse_args() if __name__ in ('__main__', '__mp_main__') else parser.parse_args([])
+
+# Pool di connessioni MariaDB, usato solo in modalità --daemon
+odin_pool = None
+# Tunnel e connessione a Odin, aperti al primo utilizzo (vedi connect_odin)
+tunnel_odin = conn_odin = cursor_odin = None
+odin_lock = threading.Lock()
+# endregion
+
+# region Metriche
+# Tempi, righe e memoria di ogni fase e di ogni istruzione SQL. Con --metrics-json vengono salvati in JSON
+# alla fine di ogni esecuzione, per seguirne l'andamento nel tempo.
+try:
+    import resource  # Non disponibile su Windows
+except ImportError:
+    resource = None
+
+metrics = {'fasi': {}, 'sql': {'app': {}, 'odin': {}}}
+metrics_lock = threading.Lock()  # Fasi e richieste di meta prodotti aggiornano le metriche da più thread
+metrics_started = datetime.now()
+
+
+def reset_metrics():
+    global metrics_started
+    with metrics_lock:
+        metrics['fasi'].clear()
+        for statements in metrics['sql'].values():
+            statements.clear()
+        # Nessuna fase in corso: la prima fase del nuovo ciclo azzera di nuovo i picchi
+        Span.active = 0
+        Span.peak_rss_reset = False
+    metrics_started = datetime.now()
+
+
+def get_max_rss_mb():
+    # Picco RSS dall'avvio del processo (non scende mai)
+    if resource is None:
+        return None
+    # ru_maxrss è in KB su Linux, in byte su macOS. Su Linux reset_peak_rss azzera anche ru_maxrss:
+    # il picco precedente è in rss_peak_before_reset_mb
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(max(rss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10), rss_peak_before_reset_mb), 1)
+
+
+def get_rss_mb():
+    # RSS attuale da /proc/self/statm (solo Linux, altrove None)
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def get_peak_rss_mb():
+    # Picco RSS dall'ultimo reset_peak_rss (VmHWM in /proc/self/status, solo Linux)
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2 ** 10
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+rss_peak_before_reset_mb = 0.0
+
+
+def reset_peak_rss():
+    # Riporta VmHWM all'RSS attuale (Linux 4.0+); False se non è possibile
+    global rss_peak_before_reset_mb
+    rss_peak_before_reset_mb = max(rss_peak_before_reset_mb, get_peak_rss_mb() or 0.0)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class Span:
+    # Misura durata, righe e memoria di una fase. Si usa come context manager oppure con start()/stop()
+    # quando inizio e fine avvengono in punti diversi (fasi di run_stages).
+    # Memoria: rss_delta_mb è la differenza di RSS tra fine e inizio della fase, picco_rss_mb il picco RSS
+    # del processo durante la fase (Linux). I picchi (anche quello tracemalloc) vengono azzerati solo se non ci
+    # sono altre fasi in corso: con fasi in parallelo comprendono anche la memoria delle altre (con --sequential
+    # sono quelli della singola fase).
+    active = 0
+    peak_rss_reset = False  # Il picco RSS è stato azzerato all'inizio delle fasi in corso
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.extra = {}
+        self.started = None
+        self.rss_started = None
+
+    def start(self):
+        with metrics_lock:
+            if Span.active == 0:
+                if tracemalloc.is_tracing():
+                    tracemalloc.reset_peak()
+                Span.peak_rss_reset = reset_peak_rss()
+            Span.active += 1
+        self.rss_started = get_rss_mb()
+        self.started = time.perf_counter()
+        return self
+
+    def stop(self):
+        record = {'secondi': round(time.perf_counter() - self.started, 4), 'righe': self.rows}
+        record.update({k: round(v, 4) if isinstance(v, float) else v for k, v in self.extra.items()})
+        if tracemalloc.is_tracing():
+            record['picco_memoria_mb'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1)
+        rss = get_rss_mb()
+        if rss is not None and self.rss_started is not None:
+            record['rss_delta_mb'] = round(rss - self.rss_started, 1)
+        peak = get_peak_rss_mb() if Span.peak_rss_reset else None
+        if peak is not None:
+            record['picco_rss_mb'] = round(peak, 1)
+        with metrics_lock:
+            Span.active = max(Span.active - 1, 0)  # reset_metrics può averlo già azzerato
+            metrics['fasi'][self.name] = record
+        if args.verbose:
+            print("Fase {}: {:.2f}s, {} righe.".format(self.name, record['secondi'], self.rows))
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def count_rows(rows, span):
+    # Conta le righe di un iterabile consumato in streaming
+    for row in rows:
+        span.rows += 1
+        yield row
+
+
+metered_batchsize = 1000  # Righe lette per blocco quando un cursore misurato viene iterato
+
+
+class MeteredCursor:
+    # Proxy del cursore (sqlite3 o mariadb): per ogni istruzione registra esecuzioni, tempo di esecuzione e
+    # lettura dei risultati, righe lette o modificate. Le istruzioni sono raggruppate per testo normalizzato.
+    def __init__(self, cursor, source):
+        self._cursor = cursor
+        self._source = source
+        self._statement = None
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        # Le righe lette iterando il cursore vengono contate a blocchi, come con fetchmany
+        while True:
+            rows = self.fetchmany(metered_batchsize)
+            if not rows:
+                return
+            yield from rows
+
+    def _record(self, seconds, rows=0, executions=0):
+        with metrics_lock:
+            entry = metrics['sql'][self._source].setdefault(
+                self._statement, {'esecuzioni': 0, 'secondi': 0.0, 'righe': 0})
+            entry['esecuzioni'] += executions
+            entry['secondi'] += seconds
+            entry['righe'] += rows
+
+    def _run(self, method, statement, *params):
+        # Gli elenchi di segnaposto (IN (?,?,...)) cambiano con la dimensione del blocco
+        self._statement = re.sub(r'\?(\s*,\s*\?)+', '?, ...', " ".join(statement.split()))
+        started = time.perf_counter()
+        try:
+            result = method(statement, *params)
+            # sqlite3 restituisce il cursore stesso (cursor.execute(...).fetchall()): le letture restano misurate
+            return self if result is self._cursor else result
+        finally:
+            # Le righe delle SELECT vengono contate in lettura
+            rowcount = self._cursor.rowcount if self._cursor.description is None else 0
+            self._record(time.perf_counter() - started, max(rowcount or 0, 0), 1)
+
+    def execute(self, statement, *params):
+        return self._run(self._cursor.execute, statement, *params)
+
+    def executemany(self, statement, *params):
+        return self._run(self._cursor.executemany, statement, *params)
+
+    def _fetch(self, method, *params):
+        started = time.perf_counter()
+        result = method(*params)
+        rows = (0 if result is None else 1) if method == self._cursor.fetchone else len(result)
+        self._record(time.perf_counter() - started, rows)
+        return result
+
+    def fetchone(self):
+        return self._fetch(self._cursor.fetchone)
+
+    def fetchmany(self, *params):
+        return self._fetch(self._cursor.fetchmany, *params)
+
+    def fetchall(self):
+        return self._fetch(self._cursor.fetchall)
+
+
+class MeteredConnection:
+    # Proxy della connessione che restituisce cursori MeteredCursor
+    def __init__(self, conn, source):
+        self._conn = conn
+        self._source = source
 
-# conn = None
-# cursor = None
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def cursor(self, *params, **kwargs):
+        return MeteredCursor(self._conn.cursor(*params, **kwargs), self._source)
+
+    # Scorciatoie di sqlite3 (conn.execute crea un cursore nuovo): misurate come le istruzioni dei cursori
+    def execute(self, statement, *params):
+        return self.cursor().execute(statement, *params)
+
+    def executemany(self, statement, *params):
+        return self.cursor().executemany(statement, *params)
+
+
+def metered(conn, source):
+    # Le istruzioni SQL vengono misurate solo se le metriche vanno salvate
+    return MeteredConnection(conn, source) if args.metrics_json else conn
+
+
+def start_profiling():
+    if args.tracemalloc:
+        tracemalloc.start()
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+
+def stop_profiling(profiler):
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        print("Profilo cProfile salvato in {}.".format(args.profile))
+        if args.verbose:
+            import pstats
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+
+
+def write_metrics(path):
+    with metrics_lock:
+        report = {
+            'avvio': metrics_started.isoformat(timespec='seconds'),
+            'fine': datetime.now().isoformat(timespec='seconds'),
+            'secondi_totali': round((datetime.now() - metrics_started).total_seconds(), 3),
+            'argomenti': vars(args),
+            'max_rss_processo_mb': get_max_rss_mb(),
+            'fasi': dict(metrics['fasi']),
+            # Istruzioni ordinate per tempo totale
+            'sql': {source: [dict(istruzione=statement, **{k: round(v, 4) if isinstance(v, float) else v
+                                                            for k, v in entry.items()})
+                             for statement, entry in sorted(statements.items(), key=lambda e: -e[1]['secondi'])]
+                    for source, statements in metrics['sql'].items()},
+        }
+    if tracemalloc.is_tracing():
+        report['tracemalloc'] = {
+            'memoria_attuale_mb': round(tracemalloc.get_traced_memory()[0] / 2 ** 20, 1),
+            'allocazioni': [str(stat) for stat in tracemalloc.take_snapshot().statistics('lineno')[:20]],
+        }
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+    if args.verbose:
+        print("Metriche salvate in {}.".format(path))
 # endregion
 
 # region Connessioni
@@ -43,46 +443,121 @@ def init_app_db():
         print("Init App DB...")
 
     try:
-        # Tabella ts_by_date
+        # Dizionari dei valori di testo ripetuti (vedi region Dizionari)
+        for table in dictionary_tables:
+            cursor_app.execute(
+                "CREATE TABLE IF NOT EXISTS {} (id INTEGER PRIMARY KEY, valore TEXT NOT NULL UNIQUE);".format(table))
+        conn_app.commit()
+        dictionary_ids.clear()
+
+        # Tabella ts_by_date: SKU e deposito come id dei dizionari, giorno come numero di giorni dal 1970-01-01.
+        # Senza rowid le righe sono ordinate per (sku_id, giorno, dep_id), la chiave della join del confronto.
+        # file_id: il file (imported_files) che ha scritto la riga, per reimportare un file modificato
         create_table_query = """
             CREATE TABLE IF NOT EXISTS ts_by_date (
-                sku TEXT NOT NULL,
-                data DATE NOT NULL,
+                sku_id INTEGER NOT NULL,
+                giorno INTEGER NOT NULL,
+                dep_id INTEGER NOT NULL,
                 qta INTEGER NOT NULL,
-                dep TEXT NOT NULL,
-                UNIQUE (sku, data, dep)
-            );
+                file_id INTEGER,
+                PRIMARY KEY (sku_id, giorno, dep_id)
+            ) WITHOUT ROWID;
             """
         cursor_app.execute(create_table_query)
+        cursor_app.execute("CREATE INDEX IF NOT EXISTS idx_ts_by_date_file ON ts_by_date (file_id);")
         conn_app.commit()
         if args.verbose:
             print("Tabella ts_by_date creata.")
 
-        # Tabella odin_by_date
+        # Tabella odin_righe: copia di inventario_completo, una riga per id_odin (anche le versioni superate di
+        # una rilevazione). La sincronizzazione scrive solo qui; i trigger (vedi odin_rows_triggers) ne ricavano
+        # odin_by_date e odin_storico. Le cancellazioni su Odin si cercano confrontando i conteggi con questa tabella.
         create_table_query = """
-            CREATE TABLE IF NOT EXISTS odin_by_date (
-                sku TEXT NOT NULL,
+            CREATE TABLE IF NOT EXISTS odin_righe (
+                id_odin INTEGER PRIMARY KEY,
+                sku_id INTEGER NOT NULL,
+                sede_id INTEGER NOT NULL,
+                sez INTEGER NOT NULL,
+                luogo_id INTEGER NOT NULL,
+                utente_id INTEGER NOT NULL,
                 qta INTEGER NOT NULL,
-                luogo TEXT NOT NULL,
+                giorno INTEGER NOT NULL,
+                data DATE NOT NULL,
+                ultima_modifica DATE NOT NULL,
+                note TEXT
+            );
+        """
+        cursor_app.execute(create_table_query)
+        # Versioni di una rilevazione in ordine di giorno e id (scelta della versione attuale)
+        cursor_app.execute("CREATE INDEX IF NOT EXISTS idx_odin_righe_chiave "
+                           "ON odin_righe (sku_id, sede_id, sez, luogo_id, utente_id, giorno, id_odin);")
+        conn_app.commit()
+        if args.verbose:
+            print("Tabella odin_righe creata.")
+
+        # Tabella odin_by_date: la versione attuale di ogni rilevazione (giorno più recente, a parità di giorno
+        # id_odin più alto). Senza rowid, ordinata per la chiave naturale della rilevazione, che inizia con
+        # (sku_id, sede_id) come la partizione del totale rilevato
+        create_table_query = """
+            CREATE TABLE IF NOT EXISTS odin_by_date (
+                sku_id INTEGER NOT NULL,
+                sede_id INTEGER NOT NULL,
                 sez INTEGER NOT NULL,
-                sede TEXT NOT NULL,
+                luogo_id INTEGER NOT NULL,
+                utente_id INTEGER NOT NULL,
+                id_odin INTEGER NOT NULL UNIQUE,
+                qta INTEGER NOT NULL,
+                giorno INTEGER NOT NULL,
                 data DATE NOT NULL,
                 ultima_modifica DATE NOT NULL,
                 note TEXT,
-                username TEXT NOT NULL,
-                UNIQUE (sku, sez, sede, luogo, username)
-        );
+                PRIMARY KEY (sku_id, sede_id, sez, luogo_id, utente_id)
+            ) WITHOUT ROWID;
         """
         cursor_app.execute(create_table_query)
         conn_app.commit()
         if args.verbose:
             print("Tabella odin_by_date creata.")
 
+        # Tabella odin_storico: tutte le versioni delle rilevazioni, una per giorno di rilevazione.
+        # Senza rowid la tabella è ordinata per chiave primaria, quindi le righe di ogni giorno (e sede)
+        # sono contigue: letture per giorno e compattazione dei giorni vecchi toccano solo quelle pagine.
+        create_table_query = """
+            CREATE TABLE IF NOT EXISTS odin_storico (
+                giorno INTEGER NOT NULL,
+                sede_id INTEGER NOT NULL,
+                sku_id INTEGER NOT NULL,
+                sez INTEGER NOT NULL,
+                luogo_id INTEGER NOT NULL,
+                utente_id INTEGER NOT NULL,
+                id_odin INTEGER NOT NULL,
+                qta INTEGER NOT NULL,
+                data DATE NOT NULL,
+                ultima_modifica DATE NOT NULL,
+                note TEXT,
+                PRIMARY KEY (giorno, sede_id, sku_id, sez, luogo_id, utente_id)
+            ) WITHOUT ROWID;
+        """
+        cursor_app.execute(create_table_query)
+        # Versioni di una rilevazione in ordine di giorno (--as-of e compattazione) e cancellazioni per id
+        cursor_app.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_odin_storico_chiave "
+                           "ON odin_storico (sku_id, sede_id, sez, luogo_id, utente_id, giorno);")
+        cursor_app.execute("CREATE INDEX IF NOT EXISTS idx_odin_storico_id ON odin_storico (id_odin);")
+        # Con una riga presente i trigger su odin_righe e odin_by_date non scattano (vedi begin_odin_bulk_load)
+        cursor_app.execute("CREATE TABLE IF NOT EXISTS caricamento_massivo (fonte TEXT PRIMARY KEY);")
+        for trigger in odin_rows_triggers:
+            cursor_app.execute(trigger)
+        conn_app.commit()
+        if args.verbose:
+            print("Tabella odin_storico creata.")
+
         # Tabella imported_ts_files
         create_table_query = """
                     CREATE TABLE IF NOT EXISTS imported_files (
+                        id INTEGER PRIMARY KEY,
                         type TEXT NOT NULL,
                         nome TEXT NOT NULL,
+                        hash TEXT,
                         data TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                         UNIQUE (type, nome)
                     );
@@ -95,10 +570,11 @@ def init_app_db():
         # Tabella products_meta
         create_table_query = """
                     CREATE TABLE IF NOT EXISTS products_meta (
-                        sku TEXT PRIMARY KEY,
+                        sku_id INTEGER PRIMARY KEY,
                         uf_cod TEXT,
                         descrizione TEXT NOT NULL,
-                        ultima_modifica TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                        ultima_modifica TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        verificato TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                     );
                     """
         cursor_app.execute(create_table_query)
@@ -106,24 +582,132 @@ def init_app_db():
         if args.verbose:
             print("Tabella products_meta creata.")
 
-        # Tabella corrected
+        # Tabella corrected: le correzioni si applicano alla rilevazione con lo stesso id_odin.
+        # id_odin è NULL finché una correzione da un file senza la colonna id_odin non viene risolta
+        # sulla chiave naturale (vedi resolve_corrected_ids). file_id come in ts_by_date.
         create_table_query = """
                     CREATE TABLE IF NOT EXISTS corrected (
-                        sku TEXT NOT NULL,
-                        luogo TEXT NOT NULL,
+                        id_odin INTEGER,
+                        sku_id INTEGER NOT NULL,
+                        luogo_id INTEGER NOT NULL,
                         sez INTEGER NOT NULL,
-                        sede TEXT NOT NULL,
-                        operatore TEXT NOT NULL,
+                        sede_id INTEGER NOT NULL,
+                        utente_id INTEGER NOT NULL,
                         ultima_modifica TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                         note TEXT,
-                        UNIQUE (sku, sez, sede, luogo, operatore)
+                        file_id INTEGER
                     );
                     """
         cursor_app.execute(create_table_query)
+        cursor_app.execute("CREATE INDEX IF NOT EXISTS idx_corrected_id ON corrected (id_odin);")
+        cursor_app.execute("CREATE INDEX IF NOT EXISTS idx_corrected_file ON corrected (file_id);")
+        # Reimportare lo stesso file non duplica le correzioni, nemmeno quelle ancora senza id_odin
+        cursor_app.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_corrected_chiave "
+                           "ON corrected (sku_id, sez, sede_id, luogo_id, utente_id, IFNULL(id_odin, 0));")
         conn_app.commit()
         if args.verbose:
             print("Tabella corrected creata.")
 
+        # Tabella sync_watermark, punto di arrivo dell'ultima sincronizzazione per ogni fonte
+        create_table_query = """
+                    CREATE TABLE IF NOT EXISTS sync_watermark (
+                        fonte TEXT PRIMARY KEY,
+                        ultima_modifica TIMESTAMP NOT NULL,
+                        id_odin INTEGER NOT NULL,
+                        aggiornato TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    );
+                    """
+        cursor_app.execute(create_table_query)
+        conn_app.commit()
+        if args.verbose:
+            print("Tabella sync_watermark creata.")
+
+        # Tabella sedi_depositi, deposito TS confrontato con ogni sede Odin
+        create_table_query = """
+                    CREATE TABLE IF NOT EXISTS sedi_depositi (
+                        sede_id INTEGER PRIMARY KEY,
+                        dep_id INTEGER NOT NULL
+                    );
+                    """
+        cursor_app.execute(create_table_query)
+        sedi = encode_values('dizionario_sedi', sedi_depositi.keys())
+        depositi = encode_values('dizionario_depositi', sedi_depositi.values())
+        cursor_app.executemany("INSERT OR IGNORE INTO sedi_depositi (sede_id, dep_id) VALUES (?,?);",
+                               [(sedi[sede], depositi[dep]) for sede, dep in sedi_depositi.items()])
+        conn_app.commit()
+        if args.verbose:
+            print("Tabella sedi_depositi creata.")
+
+        # Confronto materializzato: totali rilevati per (sku, sede), righe del confronto e SKU da ricalcolare.
+        # discrepanze contiene le righe del report già decodificate, più gli id usati da filtri e aggiornamenti.
+        # I trigger tengono aggiornati i totali e registrano gli SKU toccati da ogni modifica alle tabelle
+        # del confronto; refresh_discrepancy ricalcola solo quegli SKU. Le righe sostituite da REPLACE
+        # attivano i trigger di DELETE solo con PRAGMA recursive_triggers (vedi apply_app_pragmas).
+        cursor_app.execute("""
+            CREATE TABLE IF NOT EXISTS totali_rilevati (
+                sku_id INTEGER NOT NULL,
+                sede_id INTEGER NOT NULL,
+                totale INTEGER NOT NULL,
+                righe INTEGER NOT NULL,
+                PRIMARY KEY (sku_id, sede_id)
+            ) WITHOUT ROWID;
+        """)
+        cursor_app.execute("""
+            CREATE TABLE IF NOT EXISTS discrepanze (
+                id_odin INTEGER,
+                sku TEXT NOT NULL,
+                uf_cod TEXT,
+                descrizione TEXT,
+                qta_rilevata INTEGER,
+                totale_qta_rilevata INTEGER,
+                qta_ts INTEGER,
+                discrepanza INTEGER,
+                sede TEXT,
+                luogo TEXT,
+                sez INTEGER,
+                deposito TEXT,
+                data_rilevazione DATE,
+                data_ts DATE,
+                note_rilevazione TEXT,
+                operatore TEXT,
+                sku_id INTEGER NOT NULL,
+                sede_id INTEGER NOT NULL,
+                giorno INTEGER NOT NULL,
+                dep_sede_id INTEGER NOT NULL
+            );
+        """)
+        cursor_app.execute("CREATE INDEX IF NOT EXISTS idx_discrepanze_sku ON discrepanze (sku_id);")
+        cursor_app.execute("CREATE TABLE IF NOT EXISTS discrepanze_sku_modificati (sku_id INTEGER PRIMARY KEY);")
+        for trigger in discrepancy_triggers:
+            cursor_app.execute(trigger)
+        conn_app.commit()
+        if args.verbose:
+            print("Tabelle del confronto materializzato create.")
+
+        # Versioni dei dati per la cache dei risultati: i trigger segnano in versioni_dati_modificate le tabelle
+        # del confronto toccate, get_data_fingerprint ne incrementa la versione. La riga 'database' (istante di
+        # creazione) distingue un database ricreato con --reset, le cui versioni ripartono da zero.
+        cursor_app.execute("CREATE TABLE IF NOT EXISTS versioni_dati (tabella TEXT PRIMARY KEY, "
+                           "versione INTEGER NOT NULL) WITHOUT ROWID;")
+        cursor_app.execute("CREATE TABLE IF NOT EXISTS versioni_dati_modificate (tabella TEXT PRIMARY KEY) "
+                           "WITHOUT ROWID;")
+        cursor_app.executemany("INSERT OR IGNORE INTO versioni_dati (tabella, versione) VALUES (?,?);",
+                               [(table, 0) for table in data_version_tables] + [('database', time.time_ns())])
+        for trigger in data_version_triggers:
+            cursor_app.execute(trigger)
+        conn_app.commit()
+        if args.verbose:
+            print("Tabelle delle versioni dei dati create.")
+
+        # Le join di calc_discrepancy usano le chiavi primarie di odin_by_date e ts_by_date; indice per i filtri
+        # --from/--to/--sede
+        cursor_app.execute("CREATE INDEX IF NOT EXISTS idx_odin_by_date_giorno ON odin_by_date (giorno, sede_id, sku_id);")
+        conn_app.commit()
+        if args.verbose:
+            print("Indici creati.")
+
+        cursor_app.execute("PRAGMA user_version = {};".format(schema_version))
+        conn_app.commit()
 
     except sqlite3.Error as e:
         print(e)
@@ -131,7 +715,232 @@ def init_app_db():
     print("Database App creato. (SQLite)")
 
 
+odin_columns = "id_odin, sku_id, qta, luogo_id, sez, sede_id, data, giorno, ultima_modifica, note, utente_id"
+
+
+def odin_key_condition(alias, row):
+    # Stessa rilevazione (SKU, sede, sezione, luogo, operatore) di `row` (new, old o un alias)
+    return " AND ".join("{0}.{2} = {1}.{2}".format(alias, row, col)
+                        for col in ('sku_id', 'sede_id', 'sez', 'luogo_id', 'utente_id'))
+
+
+# Trigger che ricavano da odin_righe la versione attuale di ogni rilevazione (odin_by_date) e una versione per
+# giorno (odin_storico), la più recente per id_odin. Una versione vecchia modificata su Odin aggiorna solo il suo
+# giorno nello storico, non la rilevazione attuale. La sincronizzazione scrive con INSERT OR REPLACE e DELETE:
+# una riga sostituita passa dal trigger di DELETE (recursive_triggers, vedi apply_app_pragmas) e poi da quello
+# di INSERT, che valuta di nuovo la versione attuale anche se l'id ha cambiato rilevazione.
+odin_rows_triggers = [
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_odin_righe_ins AFTER INSERT ON odin_righe
+    WHEN NOT EXISTS (SELECT 1 FROM caricamento_massivo)
+    BEGIN
+        INSERT OR REPLACE INTO odin_by_date ({0})
+        SELECT {1}
+        WHERE NOT EXISTS (
+            SELECT 1 FROM odin_by_date o
+            WHERE {2} AND (o.giorno > new.giorno OR (o.giorno = new.giorno AND o.id_odin > new.id_odin))
+        );
+        INSERT OR REPLACE INTO odin_storico ({0})
+        SELECT {1}
+        WHERE NOT EXISTS (
+            SELECT 1 FROM odin_storico s WHERE {3} AND s.giorno = new.giorno AND s.id_odin > new.id_odin
+        );
+    END;
+    """.format(odin_columns, ", ".join("new." + col for col in odin_columns.split(", ")),
+               odin_key_condition('o', 'new'), odin_key_condition('s', 'new')),
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_odin_righe_del AFTER DELETE ON odin_righe
+    WHEN NOT EXISTS (SELECT 1 FROM caricamento_massivo)
+    BEGIN
+        DELETE FROM odin_by_date WHERE id_odin = old.id_odin;
+        INSERT INTO odin_by_date ({0})
+        SELECT {0} FROM odin_righe r
+        WHERE {1} AND NOT EXISTS (SELECT 1 FROM odin_by_date o WHERE {2})
+        ORDER BY r.giorno DESC, r.id_odin DESC
+        LIMIT 1;
+        INSERT OR REPLACE INTO odin_storico ({0})
+        SELECT {0} FROM odin_righe r
+        WHERE {1} AND r.giorno = old.giorno AND EXISTS (SELECT 1 FROM odin_storico s WHERE s.id_odin = old.id_odin)
+        ORDER BY r.id_odin DESC
+        LIMIT 1;
+        DELETE FROM odin_storico WHERE id_odin = old.id_odin;
+    END;
+    """.format(odin_columns, odin_key_condition('r', 'old'), odin_key_condition('o', 'old')),
+]
+
+# Aggiornamento di products_meta che cambia il confronto (non il solo controllo in verificato)
+products_meta_changed = \
+    "old.uf_cod IS NOT new.uf_cod OR old.descrizione IS NOT new.descrizione OR old.sku_id IS NOT new.sku_id"
+
+# Trigger del confronto materializzato (vedi init_app_db)
+discrepancy_triggers = [
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_odin_by_date_totali_ins AFTER INSERT ON odin_by_date
+    WHEN NOT EXISTS (SELECT 1 FROM caricamento_massivo)
+    BEGIN
+        INSERT INTO totali_rilevati (sku_id, sede_id, totale, righe) VALUES (new.sku_id, new.sede_id, new.qta, 1)
+        ON CONFLICT (sku_id, sede_id) DO UPDATE SET totale = totale + excluded.totale, righe = righe + 1;
+        INSERT OR IGNORE INTO discrepanze_sku_modificati (sku_id) VALUES (new.sku_id);
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_odin_by_date_totali_del AFTER DELETE ON odin_by_date
+    WHEN NOT EXISTS (SELECT 1 FROM caricamento_massivo)
+    BEGIN
+        UPDATE totali_rilevati SET totale = totale - old.qta, righe = righe - 1
+        WHERE sku_id = old.sku_id AND sede_id = old.sede_id;
+        DELETE FROM totali_rilevati WHERE sku_id = old.sku_id AND sede_id = old.sede_id AND righe = 0;
+        INSERT OR IGNORE INTO discrepanze_sku_modificati (sku_id) VALUES (old.sku_id);
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_odin_by_date_totali_upd AFTER UPDATE ON odin_by_date
+    WHEN NOT EXISTS (SELECT 1 FROM caricamento_massivo)
+    BEGIN
+        UPDATE totali_rilevati SET totale = totale - old.qta, righe = righe - 1
+        WHERE sku_id = old.sku_id AND sede_id = old.sede_id;
+        DELETE FROM totali_rilevati WHERE sku_id = old.sku_id AND sede_id = old.sede_id AND righe = 0;
+        INSERT INTO totali_rilevati (sku_id, sede_id, totale, righe) VALUES (new.sku_id, new.sede_id, new.qta, 1)
+        ON CONFLICT (sku_id, sede_id) DO UPDATE SET totale = totale + excluded.totale, righe = righe + 1;
+        INSERT OR IGNORE INTO discrepanze_sku_modificati (sku_id) VALUES (old.sku_id), (new.sku_id);
+    END;
+    """,
+] + [
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_{0}_discrepanze_{1} AFTER {2} ON {0}
+    BEGIN
+        INSERT OR IGNORE INTO discrepanze_sku_modificati (sku_id) VALUES {3};
+    END;
+    """.format(table, name, event, values)
+    for table in ('ts_by_date', 'corrected', 'products_meta')
+    for name, event, values in (('ins', 'INSERT', "(new.sku_id)"), ('del', 'DELETE', "(old.sku_id)"),
+                                ('upd', 'UPDATE', "(old.sku_id), (new.sku_id)"))
+    # products_meta: l'upsert aggiorna verificato a ogni controllo, conta solo un cambio di codice o descrizione
+    if not (table == 'products_meta' and name == 'upd')
+] + [
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_products_meta_discrepanze_upd AFTER UPDATE ON products_meta
+    WHEN {}
+    BEGIN
+        INSERT OR IGNORE INTO discrepanze_sku_modificati (sku_id) VALUES (old.sku_id), (new.sku_id);
+    END;
+    """.format(products_meta_changed),
+] + [
+    # Cambia il deposito confrontato con la sede: tutti gli SKU rilevati nella sede
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_sedi_depositi_discrepanze_{0} AFTER {1} ON sedi_depositi
+    BEGIN
+        INSERT OR IGNORE INTO discrepanze_sku_modificati (sku_id)
+        SELECT DISTINCT sku_id FROM odin_by_date WHERE sede_id IN ({2});
+    END;
+    """.format(name, event, values)
+    for name, event, values in (('ins', 'INSERT', "new.sede_id"), ('del', 'DELETE', "old.sede_id"),
+                                ('upd', 'UPDATE', "old.sede_id, new.sede_id"))
+]
+
+# Tabelle lette dal confronto (anche con --as-of) e trigger che ne segnano le modifiche (vedi get_data_fingerprint).
+# Un solo INSERT OR IGNORE per riga: dopo la prima riga modificata è una ricerca sulla chiave primaria.
+data_version_tables = ('ts_by_date', 'odin_by_date', 'odin_storico', 'corrected', 'products_meta', 'sedi_depositi')
+data_version_triggers = [
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_{0}_versione_{1} AFTER {2} ON {0} {3}
+    BEGIN
+        INSERT OR IGNORE INTO versioni_dati_modificate (tabella) VALUES ('{0}');
+    END;
+    """.format(table, name, event,
+               "WHEN " + products_meta_changed if (table, name) == ('products_meta', 'upd') else "")
+    for table in data_version_tables
+    for name, event in (('ins', 'INSERT'), ('del', 'DELETE'), ('upd', 'UPDATE'))
+]
+
+
+def apply_app_pragmas():
+    # Con REPLACE le righe sostituite attivano i trigger di DELETE (totali del confronto materializzato)
+    # solo con recursive_triggers, che vale per la singola connessione
+    cursor_app.execute("PRAGMA recursive_triggers = ON;")
+
+
+def check_app_db_schema():
+    # Un database creato da una versione precedente dello script va ricreato (i dati si reimportano dalle fonti)
+    cursor_app.execute("PRAGMA user_version;")
+    version = cursor_app.fetchone()[0]
+    if version != schema_version:
+        print("Il database {} usa lo schema versione {}, richiesta {}. Rilancia con --reset.".format(
+            database, version, schema_version))
+        exit(1)
+
+
+def apply_fast_load_pragmas():
+    # inventario.db si può sempre ricostruire dalle fonti: in importazione si rinuncia al fsync
+    cursor_app.execute("PRAGMA journal_mode = WAL;")
+    cursor_app.execute("PRAGMA synchronous = OFF;")
+    cursor_app.execute("PRAGMA cache_size = -262144;")  # 256 MB
+    cursor_app.execute("PRAGMA temp_store = MEMORY;")
+    if args.verbose:
+        print("PRAGMA di caricamento veloce attivati.")
+
+
+def get_odin_connection_params(tunnel):
+    return dict(
+        user=os.getenv('ODIN_DB_NAME'),
+        password=os.getenv('ODIN_DB_PW'),
+        host=tunnel.local_bind_host,
+        port=tunnel.local_bind_port,
+        database=os.getenv('ODIN_DB_NAME')
+    )
+
+
+def open_odin_connection(tunnel):
+    # Con il pool attivo la connessione viene presa dal pool e close() la restituisce
+    if odin_pool is not None:
+        return metered(odin_pool.get_connection(), 'odin')
+    return metered(mariadb.connect(**get_odin_connection_params(tunnel)), 'odin')
+
+
+def open_odin_pool(tunnel, size):
+    global odin_pool
+    odin_pool = mariadb.ConnectionPool(pool_name="odin", pool_size=size, **get_odin_connection_params(tunnel))
+
+
+def close_odin_pool():
+    global odin_pool
+    if odin_pool is not None:
+        odin_pool.close()
+        odin_pool = None
+
+
+def ensure_odin_alive():
+    # Controllo di salute per la modalità --daemon: riavvia il tunnel se è caduto e riapre la connessione
+    # principale se non risponde più
+    global conn_odin, cursor_odin
+    if conn_odin is None:
+        return  # Non ancora usata: verrà aperta al primo utilizzo
+    tunnel_restarted = False
+    if not tunnel_odin.is_active:
+        print("Tunnel SSH verso Odin non attivo, lo riavvio...")
+        close_odin_pool()
+        tunnel_odin.restart()
+        open_odin_pool(tunnel_odin, args.meta_workers + 1)
+        tunnel_restarted = True
+    try:
+        if tunnel_restarted:
+            raise mariadb.Error("tunnel riavviato")
+        conn_odin.ping()
+    except mariadb.Error as e:
+        if args.verbose:
+            print("Riapro la connessione a Odin. ({})".format(e))
+        try:
+            conn_odin.close()
+        except mariadb.Error:
+            pass
+        conn_odin = metered(mariadb.connect(**get_odin_connection_params(tunnel_odin)), 'odin')
+        cursor_odin = conn_odin.cursor()
+
+
 def connect_db_odin():
+    from dotenv import load_dotenv
+    from sshtunnel import SSHTunnelForwarder
+    load_dotenv()  # Carica i segreti dall'.env
     tunnel = None
     conn = None
 
@@ -141,7 +950,8 @@ def connect_db_odin():
             ssh_username=os.getenv('ODIN_SSH_USERNAME'),
             ssh_password=os.getenv('ODIN_SSH_PW'),
             remote_bind_address=(os.getenv('ODIN_DB_HOST'), int(os.getenv('ODIN_DB_PORT'))),
-            local_bind_address=('127.0.0.1', 3308)
+            # Porta locale 0 = scelta dal sistema, così più esecuzioni possono convivere
+            local_bind_address=('127.0.0.1', int(os.getenv('ODIN_LOCAL_PORT', 0)))
         )
         tunnel.start()
         if args.verbose:
@@ -151,237 +961,1207 @@ def connect_db_odin():
         exit(1)
 
     try:
-        conn = mariadb.connect(
-            user=os.getenv('ODIN_DB_NAME'),
-            password=os.getenv('ODIN_DB_PW'),
-            host=tunnel.local_bind_host,
-            port=tunnel.local_bind_port,
-            database=os.getenv('ODIN_DB_NAME')
-        )
+        conn = mariadb.connect(**get_odin_connection_params(tunnel))
     except mariadb.Error as e:
         print(e)
         exit(1)
     return tunnel, conn
 
 
+def run_odin_command(command, stdin=b''):
+    # Esegue command sul server SSH di Odin sulla connessione SSH del tunnel. Restituisce stdout (file binario)
+    # e una funzione che attende la fine del comando e restituisce (codice di uscita, stderr).
+    channel = tunnel_odin._transport.open_session()
+    channel.exec_command(command)
+    channel.sendall(stdin)
+    channel.shutdown_write()
+    stderr = channel.makefile_stderr('rb')
+    return channel.makefile('rb'), lambda: (channel.recv_exit_status(), stderr.read())
+
+
+def connect_odin():
+    # Tunnel e connessione a Odin vengono aperti al primo utilizzo: le esecuzioni solo locali
+    # (--skip-odin, nessun meta da scaricare) non contattano il server e funzionano anche offline
+    global tunnel_odin, conn_odin, cursor_odin
+    with odin_lock:
+        if conn_odin is not None:
+            return
+        with Span('connessione_odin'):
+            tunnel_odin, conn = connect_db_odin()
+        conn_odin = metered(conn, 'odin')
+        cursor_odin = conn_odin.cursor()
+        if args.daemon:
+            open_odin_pool(tunnel_odin, args.meta_workers + 1)
+
+
 # end region
 
+# region Dizionari
+# Le colonne di testo ripetute in ogni riga (SKU, sedi, depositi, luoghi, operatori) sono salvate come id interi:
+# ogni valore distinto compare una sola volta nel suo dizionario e join e raggruppamenti confrontano interi.
+# I giorni sono numeri di giorni dal 1970-01-01 (in SQLite: date(giorno * 86400, 'unixepoch')).
+dictionary_tables = ('dizionario_sku', 'dizionario_sedi', 'dizionario_depositi', 'dizionario_luoghi',
+                     'dizionario_utenti')
+dictionary_ids = {}  # tabella -> {valore: id} già letti; gli id non cambiano finché il database non viene ricreato
+epoch = date(1970, 1, 1)
+
+
+def encode_values(table, values):
+    # valore -> id per i valori dati, con i valori nuovi inseriti nel dizionario (e subito salvati, perché
+    # restino validi anche se la scrittura che li usa viene annullata)
+    ids = dictionary_ids.setdefault(table, {})
+    missing = list({str(value) for value in values} - ids.keys())
+    for i in range(0, len(missing), 500):
+        chunk = missing[i:i + 500]
+        cursor_app.executemany("INSERT OR IGNORE INTO {} (valore) VALUES (?);".format(table), [(v,) for v in chunk])
+        cursor_app.execute("SELECT valore, id FROM {} WHERE valore IN ({});".format(table, ",".join("?" * len(chunk))),
+                           chunk)
+        ids.update(cursor_app.fetchall())
+    if missing:
+        conn_app.commit()
+    return ids
+
+
+def encode_column(table, series):
+    # Colonna di testo -> colonna di id (Int64, NULL resta NULL), con un solo accesso al dizionario per valore distinto
+    values = series.where(series.isna(), series.astype(str))
+    ids = encode_values(table, values.dropna().unique())
+    return values.map(ids).astype('Int64')
+
+
+def lookup_ids(table, values):
+    # Id dei valori già presenti nel dizionario, senza inserire (filtri): un valore sconosciuto non ha righe
+    ids = dictionary_ids.setdefault(table, {})
+    missing = [str(value) for value in values if str(value) not in ids]
+    if missing:
+        cursor_app.execute("SELECT valore, id FROM {} WHERE valore IN ({});".format(
+            table, ",".join("?" * len(missing))), missing)
+        ids.update(cursor_app.fetchall())
+    return [ids[str(value)] for value in values if str(value) in ids]
+
+
+def decode_column(table, series):
+    # Colonna di id -> colonna di testo, leggendo dal dizionario solo gli id presenti
+    present = [int(i) for i in series.dropna().unique()]
+    values = {}
+    for i in range(0, len(present), 500):
+        chunk = present[i:i + 500]
+        cursor_app.execute("SELECT id, valore FROM {} WHERE id IN ({});".format(table, ",".join("?" * len(chunk))),
+                           chunk)
+        values.update(cursor_app.fetchall())
+    return series.map(values)
+
+
+def get_default_dep_id():
+    # Deposito delle sedi non presenti in sedi_depositi: se non è mai stato importato nessuna giacenza vi corrisponde
+    ids = lookup_ids('dizionario_depositi', [deposito_default])
+    return ids[0] if ids else -1
+
+
+def day_number(day):
+    return (day - epoch).days
+
+
+def to_day_numbers(series):
+    return pd.to_datetime(series).values.astype('datetime64[D]').astype('int64')
+# endregion
+
 # region Queries
-def get_odin_inventario_completo_total_rows():
+def get_odin_filter():
+    # Condizioni di --from/--to/--sede sulla query di inventario_completo (alias ic, sedi s)
+    conditions, params = [], []
+    if args.date_from:
+        conditions.append("ic.data_creazione >= ?")
+        params.append(str(args.date_from))
+    if args.date_to:
+        conditions.append("ic.data_creazione < ?")
+        params.append(str(args.date_to + timedelta(days=1)))
+    if args.sede:
+        conditions.append("s.nome IN ({})".format(",".join("?" * len(args.sede))))
+        params += args.sede
+    return conditions, params
+
+
+def get_local_filter(alias='o', sede=True):
+    # Le stesse condizioni su odin_by_date, dove il giorno di rilevazione è salvato a parte (numero di giorno)
+    conditions, params = [], []
+    if args.date_from:
+        conditions.append("{}.giorno >= ?".format(alias))
+        params.append(day_number(args.date_from))
+    if args.date_to:
+        conditions.append("{}.giorno <= ?".format(alias))
+        params.append(day_number(args.date_to))
+    if sede and args.sede:
+        sedi = lookup_ids('dizionario_sedi', args.sede)
+        conditions.append("{}.sede_id IN ({})".format(alias, ",".join("?" * len(sedi))))
+        params += sedi
+    return conditions, params
+
+
+def get_sedi_depositi():
+    # Mappatura sede -> deposito TS decodificata
+    cursor_app.execute("""
+        SELECT s.valore, d.valore
+        FROM sedi_depositi sd
+        JOIN dizionario_sedi s ON s.id = sd.sede_id
+        JOIN dizionario_depositi d ON d.id = sd.dep_id;
+    """)
+    return dict(cursor_app.fetchall())
+
+
+def get_filter_depositi():
+    # Depositi TS interessati da --deposito e dalle sedi di --sede (None = tutti)
+    depositi = set(args.deposito) if args.deposito else None
+    if args.sede:
+        mapping = get_sedi_depositi()
+        sede_depositi = {mapping.get(sede, deposito_default) for sede in args.sede}
+        depositi = sede_depositi if depositi is None else depositi & sede_depositi
+    return depositi
+
+
+def get_odin_inventario_completo_total_rows(filters=None):
+    connect_odin()
     if args.verbose:
         print("Conto righe inventario Odin...")
-    cursor_odin.execute(
-        "SELECT COUNT(*) FROM inventario_completo ic LEFT JOIN prodotti p ON ic.id_prod = p.id LEFT JOIN sedi s ON s.id = ic.id_sede;")
+    # Le LEFT JOIN su prodotti e sedi (per chiave primaria) non cambiano il numero di righe
+    conditions, params = filters or ([], [])
+    if conditions:
+        cursor_odin.execute("SELECT COUNT(*) FROM inventario_completo ic LEFT JOIN sedi s ON s.id = ic.id_sede "
+                            "WHERE {};".format(" AND ".join(conditions)), params)
+    else:
+        cursor_odin.execute("SELECT COUNT(*) FROM inventario_completo;")
     return cursor_odin.fetchone()[0]
 
 
 def get_imported_files(file_type):
+    # nome -> hash del contenuto al momento dell'importazione
     global cursor_app
     query = """
-    SELECT nome FROM imported_files where type = '{}';
-    """.format(file_type)
-    cursor_app.execute(query)
+    SELECT nome, hash FROM imported_files where type = ?;
+    """
+    cursor_app.execute(query, (file_type,))
     result = cursor_app.fetchall()
-    return [x[0] for x in result]
+    return dict(result)
 
 
-def insert_imported_file(file_type, name):
+def insert_imported_file(file_type, name, file_hash=None):
+    # Upsert: l'id del file resta lo stesso (vedi get_imported_file_id)
     global cursor_app
     query = """
-    INSERT INTO imported_files (type, nome) VALUES (?,?);
+    INSERT INTO imported_files (type, nome, hash) VALUES (?,?,?)
+    ON CONFLICT (type, nome) DO UPDATE SET hash = excluded.hash, data = CURRENT_TIMESTAMP;
     """
-    cursor_app.execute(query, (file_type, name))
+    cursor_app.execute(query, (file_type, name, file_hash))
     conn_app.commit()
 
 
-def get_odin_inventario_completo_as_df(batchsize=5):
+def get_imported_file_id(file_type, name):
+    # Id stabile del file, salvato in file_id nelle righe importate. Un file nuovo viene registrato senza hash:
+    # se l'importazione si interrompe, alla prossima esecuzione risulta importato solo in parte e viene ripreso.
+    cursor_app.execute("INSERT OR IGNORE INTO imported_files (type, nome, hash) VALUES (?,?,NULL);",
+                       (file_type, name))
+    cursor_app.execute("SELECT id FROM imported_files WHERE type = ? AND nome = ?;", (file_type, name))
+    return cursor_app.fetchone()[0]
+
+
+def get_odin_inventario_completo_as_df(batchsize=10000, mode='keyset', watermark=None, filters=None):
+    # Scarica inventario_completo a blocchi di `batchsize` righe.
+    # keyset: ogni blocco riparte dall'ultimo ic.id letto (WHERE ic.id > ?), niente OFFSET da riscandire.
+    # stream: una sola query su cursore non bufferizzato, le righe arrivano con fetchmany.
+    # incremental: solo le righe create/modificate dopo `watermark` (ultima_modifica, id_odin),
+    #              keyset sulla coppia (ic.ultima_modifica, ic.id).
+    # snapshot: la query completa eseguita sul server e trasferita compressa (vedi get_odin_snapshot_as_df),
+    #           senza filtri (il client mysql non riceve parametri).
+    # filters: condizioni aggiuntive (vedi get_odin_filter) applicate da Odin.
     global total_rows_odin
-    offset = 0
-    with tqdm(total=total_rows_odin, desc="Carico dati Odin...", unit="righe") as pbar:
-        while offset < total_rows_odin:
-            query = f"""
-            SELECT
-            IFNULL(cod,old_cod) AS sku,
-            qta,
-            luogo,
-            sezione AS sez,
-            s.nome AS sede,
-            ic.data_creazione AS `data`,
-            ic.ultima_modifica AS ultima_modifica,
-            ic.note,
-            u.username
-            FROM inventario_completo ic 
-            LEFT JOIN prodotti p ON ic.id_prod = p.id
-            LEFT JOIN sedi s ON s.id = ic.id_sede
-            LEFT JOIN users u ON u.id = ic.id_user
-            LIMIT {batchsize} OFFSET {offset};
-            """
-            cursor_odin.execute(query)
-            result = cursor_odin.fetchall()
-            if not result:
-                break
-            result = pd.DataFrame.from_records(result,
-                                               columns=["sku", "qta", "luogo", "sez", "sede", "data", "ultima_modifica",
-                                                        "note", "username"])
-            yield result
-            offset += batchsize
-            pbar.update(len(result))
+    connect_odin()
+    filter_conditions, filter_params = filters or ([], [])
 
+    def where(*conditions):
+        conditions = list(conditions) + filter_conditions
+        return "WHERE " + " AND ".join(conditions) if conditions else ""
 
-def transfer_missing_products_meta_to_local_db(batchsize=5):
-    global conn_app
-    global cursor_app
-    global cursor_odin
-    result = None
-    query_missing_meta = """
-    SELECT sku
-    FROM odin_by_date
-    WHERE sku NOT IN (SELECT sku FROM products_meta);
+    query = """
+    SELECT
+    ic.id AS id_odin,
+    IFNULL(cod,old_cod) AS sku,
+    qta,
+    luogo,
+    sezione AS sez,
+    s.nome AS sede,
+    ic.data_creazione AS `data`,
+    ic.ultima_modifica AS ultima_modifica,
+    ic.note,
+    u.username
+    FROM inventario_completo ic 
+    LEFT JOIN prodotti p ON ic.id_prod = p.id
+    LEFT JOIN sedi s ON s.id = ic.id_sede
+    LEFT JOIN users u ON u.id = ic.id_user
+    {}
+    ORDER BY {}
+    {};
     """
-    cursor_app.execute(query_missing_meta)
-    missing_skus = [m[0] for m in cursor_app.fetchall()]
-    if args.verbose:
-        print("Ho trovato {} meta da scaricare.".format(len(missing_skus)))
+    columns = ["id_odin", "sku", "qta", "luogo", "sez", "sede", "data", "ultima_modifica", "note", "username"]
+    with tqdm(total=total_rows_odin, desc="Carico dati Odin...", unit="righe") as pbar:
+        if mode == 'snapshot':
+            for result in get_odin_snapshot_as_df(query.format(where(), "ic.id", ""), columns, batchsize):
+                yield result
+                pbar.update(len(result))
+        elif mode == 'stream':
+            cursor = conn_odin.cursor(buffered=False)
+            try:  # Chiuso anche se lo scaricamento viene interrotto (vedi run_stages)
+                cursor.execute(query.format(where(), "ic.id", ""), filter_params)
+                while True:
+                    result = cursor.fetchmany(batchsize)
+                    if not result:
+                        break
+                    result = pd.DataFrame.from_records(result, columns=columns)
+                    yield result
+                    pbar.update(len(result))
+            finally:
+                cursor.close()
+        elif mode == 'incremental':
+            last_modified, last_id = watermark or ('1970-01-01 00:00:00', 0)
+            while True:
+                cursor_odin.execute(query.format(
+                    where("(ic.ultima_modifica > ? OR (ic.ultima_modifica = ? AND ic.id > ?))"),
+                    "ic.ultima_modifica, ic.id",
+                    "LIMIT ?"), (last_modified, last_modified, last_id, *filter_params, batchsize))
+                result = cursor_odin.fetchall()
+                if not result:
+                    break
+                result = pd.DataFrame.from_records(result, columns=columns)
+                last_modified, last_id = str(result['ultima_modifica'].iloc[-1]), int(result['id_odin'].iloc[-1])
+                yield result
+                pbar.update(len(result))
+                if len(result) < batchsize:
+                    break
+        else:
+            last_id = 0
+            while True:
+                cursor_odin.execute(query.format(where("ic.id > ?"), "ic.id", "LIMIT ?"),
+                                    (last_id, *filter_params, batchsize))
+                result = cursor_odin.fetchall()
+                if not result:
+                    break
+                result = pd.DataFrame.from_records(result, columns=columns)
+                last_id = int(result['id_odin'].iloc[-1])
+                yield result
+                pbar.update(len(result))
+                if len(result) < batchsize:
+                    break
+
+
+class ByteCounter:
+    # File in lettura che conta i byte letti
+    def __init__(self, f):
+        self.f = f
+        self.bytes = 0
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.bytes += len(data)
+        return data
+
+    def __iter__(self):  # pandas tratta come file gli oggetti con read e __iter__
+        return iter(self.f)
+
+
+mysql_batch_escapes = {'0': '\0', 't': '\t', 'n': '\n', '\\': '\\'}
+
+
+def decode_mysql_batch(series):
+    # mysql --batch scrive i caratteri NUL, tab, a capo e backslash dei valori come \0, \t, \n e \\
+    escaped = series.str.contains('\\', regex=False, na=False)
+    if not escaped.any():
+        return series
+    return series.where(~escaped, series[escaped].str.replace(
+        r'\\(.)', lambda m: mysql_batch_escapes.get(m.group(1), m.group(1)), regex=True))
+
+
+def get_odin_snapshot_command(query):
+    template = os.getenv('ODIN_SNAPSHOT_COMMAND') or odin_snapshot_command
+    command = template.format(host=shlex.quote(os.getenv('ODIN_DB_HOST', '')),
+                              port=shlex.quote(os.getenv('ODIN_DB_PORT', '')),
+                              user=shlex.quote(os.getenv('ODIN_DB_NAME', '')),
+                              database=shlex.quote(os.getenv('ODIN_DB_NAME', '')),
+                              query=shlex.quote(" ".join(query.split())))
+    # Con pipefail un errore di mysql non viene nascosto dal codice di uscita di gzip
+    return "bash -o pipefail -c {}".format(shlex.quote(command))
+
+
+def get_odin_snapshot_as_df(query, columns, batchsize=10000, numeric_columns=('id_odin', 'qta', 'sez')):
+    # Snapshot completo: la query (join comprese) viene eseguita una volta sola sul server SSH di Odin dal client
+    # mysql e il risultato, TSV compresso con gzip, arriva sulla connessione SSH del tunnel invece che riga per
+    # riga con il protocollo MariaDB. I blocchi di batchsize righe vengono letti dal parser C di pandas.
+    # In mysql --batch NULL è il testo NULL: un valore di testo 'NULL' diventa anch'esso NULL.
+    text_columns = [col for col in columns if col not in numeric_columns]
+    password = (os.getenv('ODIN_DB_PW') or '').replace('\\', '\\\\').replace('"', '\\"')
+    with Span('snapshot_odin') as span:
+        stdout, wait = run_odin_command(get_odin_snapshot_command(query),
+                                        '[client]\npassword="{}"\n'.format(password).encode())
+        compressed = ByteCounter(stdout)
+        data = ByteCounter(gzip.GzipFile(fileobj=compressed))
+        try:
+            reader = pd.read_csv(data, sep='\t', header=None, names=columns, quoting=csv.QUOTE_NONE,
+                                 dtype={col: str for col in text_columns}, na_values=['NULL'],
+                                 keep_default_na=False, chunksize=batchsize)
+        except pd.errors.EmptyDataError:
+            reader = ()  # Nessuna riga
+        for result in reader:
+            span.rows += len(result)
+            yield result.assign(**{col: decode_mysql_batch(result[col]) for col in text_columns})
+        status, errors = wait()
+        span.extra.update(mb_trasferiti=compressed.bytes / 2 ** 20, mb_non_compressi=data.bytes / 2 ** 20)
+        if status != 0:
+            raise RuntimeError("Snapshot da Odin non riuscito (codice {}): {}".format(
+                status, errors.decode(errors='replace').strip()))
+        if args.verbose:
+            print("Snapshot Odin: {:.1f} MB trasferiti ({:.1f} MB non compressi).".format(
+                compressed.bytes / 2 ** 20, data.bytes / 2 ** 20))
 
-    with tqdm(total=len(missing_skus), desc="Trasferisco meta prodotti da Odin", unit="prodotti") as pbar:
-        while len(missing_skus)>0:
-            batchsize = min(batchsize, len(missing_skus))
-            this_missing_skus = [missing_skus.pop() for _ in range(batchsize)]
-            this_missing_skus_where = ["\"{}\"".format(s) for s in this_missing_skus]
-            this_missing_skus_where = ",".join(this_missing_skus_where)
-            if args.verbose:
-                print(this_missing_skus)
-
-            query = """
-                SELECT
-                IFNULL(cod,old_cod) AS sku,
-                uf_cod,
-                descrizione
-                FROM prodotti p
-                WHERE cod IN ({})
-                OR old_cod IN ({});
-                """.format(this_missing_skus_where, this_missing_skus_where)
-
-            cursor_odin.execute(query)
-            result = cursor_odin.fetchall()
-            if not result:
-                break
-            result = pd.DataFrame.from_records(result,
-                                               columns=("sku", "uf_cod", "descrizione"))
-            # Insert
-            for _, row in result.iterrows():
-                cursor_app.execute("""
-                INSERT OR IGNORE INTO products_meta (sku, uf_cod, descrizione)
-                VALUES (?,?,?);
-                """, (row['sku'], row['uf_cod'], row['descrizione']))
-            conn_app.commit()
-            pbar.update(len(result))
 
+def get_odin_now():
+    connect_odin()
+    cursor_odin.execute("SELECT CURRENT_TIMESTAMP;")
+    return cursor_odin.fetchone()[0]
 
-def import_df_in_ts_by_date(df):
-    if args.verbose:
-        print("Eseguo query importazione in ts_bt_date...")
-    for _, row in tqdm(df.iterrows(), total=df.shape[0]):
-        cursor_app.execute("""
-        INSERT OR IGNORE INTO ts_by_date (sku, data, qta, dep)
-        VALUES (?,?,?,?)
-        """, (row['sku'], row['data'], row['qta'], row['dep']))
+
+def get_sync_watermark(fonte):
+    cursor_app.execute("SELECT ultima_modifica, id_odin FROM sync_watermark WHERE fonte = ?;", (fonte,))
+    return cursor_app.fetchone()
+
+
+def set_sync_watermark(fonte, ultima_modifica, id_odin):
+    cursor_app.execute("""
+    INSERT OR REPLACE INTO sync_watermark (fonte, ultima_modifica, id_odin, aggiornato)
+    VALUES (?,?,?,CURRENT_TIMESTAMP);
+    """, (fonte, str(ultima_modifica), int(id_odin)))
     conn_app.commit()
 
 
-def import_df_in_odin_by_date(df):
-    for _, row in tqdm(
-               df.iterrows(),
-               total=df.shape[0],
-               desc="Eseguo query importazione in odin_by_date...",
-               unit="righe"):
-        row['data'] = row['data'].strftime('%Y-%m-%d %H:%M:%S')
-        row['ultima_modifica'] = row['ultima_modifica'].strftime('%Y-%m-%d %H:%M:%S')
-        cursor_app.execute("""
-        INSERT OR IGNORE INTO odin_by_date (sku, qta, luogo, sez, sede, data, ultima_modifica, note, username)
-        VALUES (?,?,?,?,?,?,?,?,?)
-        """, (
-            row['sku'],
-            row['qta'],
-            row['luogo'],
-            row['sez'],
-            row['sede'],
-            row['data'],
-            row['ultima_modifica'],
-            row['note'],
-            row['username']
-            )
-        )
+def remove_deleted_odin_rows(bucketsize=100000):
+    # Confronta i conteggi per fasce di id tra Odin e odin_righe (che ha tutte le righe di Odin): solo le fasce
+    # che non tornano vengono riscaricate (soli id) per trovare le righe cancellate su Odin.
+    connect_odin()
+    query = "SELECT {0} - {0} % ? AS fascia, COUNT(*) FROM {1} GROUP BY fascia;"
+    cursor_odin.execute(query.format("id", "inventario_completo"), (bucketsize,))
+    remote_buckets = dict(cursor_odin.fetchall())
+    cursor_app.execute(query.format("id_odin", "odin_righe"), (bucketsize,))
+    local_buckets = dict(cursor_app.fetchall())
+    changed_buckets = [b for b, n in local_buckets.items() if remote_buckets.get(b) != n]
+
+    deleted = 0
+    for bucket in tqdm(changed_buckets, desc="Verifico righe cancellate su Odin...", unit="fasce"):
+        cursor_odin.execute("SELECT id FROM inventario_completo WHERE id >= ? AND id < ?;",
+                            (bucket, bucket + bucketsize))
+        remote_ids = {r[0] for r in cursor_odin.fetchall()}
+        # I trigger tolgono le righe cancellate anche da odin_by_date e dallo storico
+        cursor_app.execute("SELECT id_odin FROM odin_righe WHERE id_odin >= ? AND id_odin < ?;",
+                           (bucket, bucket + bucketsize))
+        removed_ids = [(r[0],) for r in cursor_app.fetchall() if r[0] not in remote_ids]
+        cursor_app.executemany("DELETE FROM odin_righe WHERE id_odin = ?;", removed_ids)
+        deleted += len(removed_ids)
     conn_app.commit()
+    if args.verbose:
+        print("Rimosse {} righe cancellate su Odin.".format(deleted))
+    return deleted
+
+
+def remove_deleted_odin_rows_in_range(filters):
+    # Come remove_deleted_odin_rows, limitata alle righe dei filtri: confronta direttamente gli id
+    connect_odin()
+    conditions, params = filters
+    cursor_odin.execute("SELECT ic.id FROM inventario_completo ic LEFT JOIN sedi s ON s.id = ic.id_sede "
+                        "WHERE {};".format(" AND ".join(conditions)), params)
+    remote_ids = {r[0] for r in cursor_odin.fetchall()}
+    local_conditions, local_params = get_local_filter()
+    cursor_app.execute("SELECT o.id_odin FROM odin_righe o WHERE {};".format(" AND ".join(local_conditions)),
+                       local_params)
+    removed_ids = [(r[0],) for r in cursor_app.fetchall() if r[0] not in remote_ids]
+    cursor_app.executemany("DELETE FROM odin_righe WHERE id_odin = ?;", removed_ids)
+    deleted = len(removed_ids)
+    conn_app.commit()
+    if args.verbose:
+        print("Rimosse {} righe cancellate su Odin.".format(deleted))
+    return deleted
+
+
+def compact_odin_history(retention_days):
+    # Nei giorni più vecchi di retention_days resta solo la versione di ogni rilevazione valida a quella data:
+    # --as-of resta esatto da lì in avanti
+    cutoff = datetime.now().date() - timedelta(days=retention_days)
+    cursor_app.execute("""
+    DELETE FROM odin_storico
+    WHERE giorno < ?
+    AND EXISTS (
+        SELECT 1
+        FROM odin_storico n
+        WHERE n.sku_id = odin_storico.sku_id
+        AND n.sede_id = odin_storico.sede_id
+        AND n.sez = odin_storico.sez
+        AND n.luogo_id = odin_storico.luogo_id
+        AND n.utente_id = odin_storico.utente_id
+        AND n.giorno > odin_storico.giorno
+        AND n.giorno <= ?
+    );
+    """, (day_number(cutoff), day_number(cutoff)))
+    removed = cursor_app.rowcount
+    conn_app.commit()
+    if args.verbose:
+        print("Storico compattato fino al {}: rimosse {} versioni.".format(cutoff, removed))
+    return removed
+
+
+def write_odin_batch(batch, fonte=None):
+    rows = import_df_in_odin_by_date(batch, progress=False)
+    if fonte is not None:
+        set_sync_watermark(fonte, batch['ultima_modifica'].iloc[-1], batch['id_odin'].iloc[-1])
+    return rows
+
+
+def odin_sync_actions(mode='incremental'):
+    # Sincronizza odin_righe con inventario_completo (upsert per id_odin) e aggiorna il watermark.
+    # Il watermark viene letto subito; il generatore restituito scarica da Odin e produce le scritture
+    # su SQLite da eseguire, nell'ordine, sul thread principale (vedi run_stages).
+    fonte = 'inventario_completo'
+    watermark = get_sync_watermark(fonte)
+    filters = get_odin_filter()
+
+    def actions():
+        global total_rows_odin
+        if filters[0]:
+            # Solo le righe di --from/--to/--sede: il watermark non avanza (le altre righe non sono state
+            # scaricate) e le cancellazioni si cercano solo tra le righe filtrate
+            incremental = mode == 'incremental' and watermark is not None
+            total_rows_odin = None if incremental else get_odin_inventario_completo_total_rows(filters)
+            fetch = 'keyset' if args.odin_fetch == 'snapshot' else args.odin_fetch  # Snapshot senza parametri
+            for batch in get_odin_inventario_completo_as_df(args.odin_batch_size,
+                                                            'incremental' if incremental else fetch,
+                                                            watermark, filters):
+                yield functools.partial(write_odin_batch, batch)
+            yield functools.partial(remove_deleted_odin_rows_in_range, filters)
+            return
+        if mode == 'incremental' and watermark is not None:
+            total_rows_odin = None  # Niente COUNT(*): le righe da scaricare sono poche e non note a priori
+            if args.verbose:
+                print("Sincronizzazione incrementale da {} (id {}).".format(*watermark))
+            for batch in get_odin_inventario_completo_as_df(args.odin_batch_size, 'incremental', watermark):
+                yield functools.partial(write_odin_batch, batch, fonte)
+        else:
+            # Le modifiche fatte durante lo scaricamento completo saranno riprese dalla prossima incrementale
+            started = get_odin_now()
+            total_rows_odin = get_odin_inventario_completo_total_rows()
+            yield begin_odin_bulk_load
+            # Ogni blocco viene scritto subito in odin_righe, in memoria resta un solo blocco alla volta
+            for batch in get_odin_inventario_completo_as_df(args.odin_batch_size, args.odin_fetch):
+                yield functools.partial(write_odin_batch, batch)
+            yield functools.partial(set_sync_watermark, fonte, started, 0)
+        yield remove_deleted_odin_rows
+        if args.retention_days:
+            yield functools.partial(compact_odin_history, args.retention_days)
+        yield end_odin_bulk_load
+
+    return actions()
+
+
+def sync_odin_by_date(mode='incremental'):
+    for action in odin_sync_actions(mode):
+        action()
+
+
+def get_missing_products_meta_skus(refresh_days=0):
+    # SKU distinti presenti in odin_by_date senza meta (anti-join), più quelli controllati da più di refresh_days
+    query = """
+    SELECT ds.valore
+    FROM (SELECT DISTINCT sku_id FROM odin_by_date) o
+    JOIN dizionario_sku ds ON ds.id = o.sku_id
+    LEFT JOIN products_meta m ON m.sku_id = o.sku_id
+    WHERE m.sku_id IS NULL
+    """
+    params = ()
+    if refresh_days:
+        query += " OR m.verificato < datetime('now', ?)"
+        params = ("-{} days".format(refresh_days),)
+    cursor_app.execute(query, params)
+    return [r[0] for r in cursor_app.fetchall()]
+
+
+def fetch_products_meta(skus, batchsize=1000, workers=1):
+    # Scarica da Odin i meta degli SKU a blocchi parametrizzati; con workers > 1 i blocchi vengono
+    # richiesti in parallelo, ognuno su una connessione propria attraverso lo stesso tunnel.
+    # Restituisce (SKU richiesti, DataFrame) nell'ordine dei blocchi.
+    query = """
+        SELECT
+        IFNULL(cod,old_cod) AS sku,
+        uf_cod,
+        descrizione
+        FROM prodotti p
+        WHERE cod IN ({0})
+        OR old_cod IN ({0});
+        """
+    chunks = [skus[i:i + batchsize] for i in range(0, len(skus), batchsize)]
+    if chunks:
+        connect_odin()
 
-def import_df_in_corrected(df):
-    for _, row in tqdm(
-        df.iterrows(),
-        total=df.shape[0],
-        desc="Importo dati di correzione...",
-        unit="righe"):
-        cursor_app.execute("""
-                INSERT OR IGNORE INTO corrected (sku, luogo, sez, sede, operatore)
-                VALUES (?,?,?,?,?)
-                """, (
-            row['sku'],
-            row['luogo'],
-            row['sez'],
-            row['sede'],
-            row['operatore']
-        )
-                           )
+    def fetch(cursor, chunk):
+        cursor.execute(query.format(",".join("?" * len(chunk))), chunk + chunk)
+        return len(chunk), pd.DataFrame.from_records(cursor.fetchall(), columns=("sku", "uf_cod", "descrizione"))
+
+    if workers <= 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            yield fetch(cursor_odin, chunk)
+        return
+
+    local = threading.local()
+    connections = []
+    lock = threading.Lock()
+
+    def fetch_in_thread(chunk):
+        if not hasattr(local, 'cursor'):
+            conn = open_odin_connection(tunnel_odin)
+            with lock:
+                connections.append(conn)
+            local.cursor = conn.cursor()
+        return fetch(local.cursor, chunk)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            yield from executor.map(fetch_in_thread, chunks)
+    finally:
+        for conn in connections:
+            conn.close()
+
+
+def upsert_products_meta(df):
+    # Inserisce i meta nuovi; per quelli già presenti aggiorna la descrizione solo se è cambiata
+    rows = to_sqlite_rows(df.assign(sku_id=encode_column('dizionario_sku', df['sku'])),
+                          ('sku_id', 'uf_cod', 'descrizione'))
+    cursor_app.executemany("""
+    INSERT INTO products_meta (sku_id, uf_cod, descrizione)
+    VALUES (?,?,?)
+    ON CONFLICT (sku_id) DO UPDATE SET
+        uf_cod = excluded.uf_cod,
+        descrizione = excluded.descrizione,
+        ultima_modifica = CASE
+            WHEN products_meta.descrizione IS NOT excluded.descrizione OR products_meta.uf_cod IS NOT excluded.uf_cod
+            THEN CURRENT_TIMESTAMP ELSE products_meta.ultima_modifica END,
+        verificato = CURRENT_TIMESTAMP;
+    """, map(tuple, rows))
     conn_app.commit()
+    return len(rows)
 
-def calc_discrepancy():
-    global cursor_app
-    query = """
+
+def products_meta_actions():
+    missing_skus = get_missing_products_meta_skus(args.meta_refresh_days)
+    if args.verbose:
+        print("Ho trovato {} meta da scaricare.".format(len(missing_skus)))
+
+    def actions():
+        with tqdm(total=len(missing_skus), desc="Trasferisco meta prodotti da Odin", unit="prodotti") as pbar:
+            for requested, result in fetch_products_meta(missing_skus, args.meta_batch_size, args.meta_workers):
+                if not result.empty:
+                    yield functools.partial(upsert_products_meta, result)
+                pbar.update(requested)
+
+    return actions()
+
+
+def transfer_missing_products_meta_to_local_db():
+    for action in products_meta_actions():
+        action()
+
+
+def to_sqlite_rows(df, columns, datetime_columns=(), date_columns=()):
+    # Conversione vettoriale delle colonne: date formattate in un solo passaggio, NaN -> NULL,
+    # valori numpy -> tipi Python accettati da sqlite3
+    df = df[list(columns)].copy()
+    for col in datetime_columns:
+        df[col] = pd.to_datetime(df[col]).dt.strftime('%Y-%m-%d %H:%M:%S')
+    for col in date_columns:
+        df[col] = pd.to_datetime(df[col]).dt.strftime('%Y-%m-%d')
+    df = df.astype(object).where(df.notna(), None)
+    return df.to_numpy(dtype=object)
+
+
+def bulk_insert(table, df, columns, conflict='IGNORE', datetime_columns=(), date_columns=(), desc=None,
+                progress=True, chunksize=50000):
+    # Inserimento massivo con executemany in un'unica transazione.
+    # Oltre --stage-threshold righe i dati passano da una tabella temporanea senza indici
+    # e vengono copiati con un solo INSERT ... SELECT.
+    if df is None or df.empty:
+        return 0
+    started = time.perf_counter()
+    rows = to_sqlite_rows(df, columns, datetime_columns, date_columns)
+    column_list = ", ".join(columns)
+    placeholders = ",".join("?" * len(columns))
+    staged = args.stage_threshold and len(rows) >= args.stage_threshold
+    target = "temp.stage_{}".format(table) if staged else table
+    if staged:
+        cursor_app.execute("DROP TABLE IF EXISTS {};".format(target))
+        cursor_app.execute("CREATE TEMP TABLE stage_{} AS SELECT {} FROM {} WHERE 0;".format(table, column_list, table))
+        query = "INSERT INTO {} ({}) VALUES ({});".format(target, column_list, placeholders)
+    else:
+        query = "INSERT OR {} INTO {} ({}) VALUES ({});".format(conflict, table, column_list, placeholders)
+
+    try:
+        with tqdm(total=len(rows), desc=desc, unit="righe", disable=not progress) as pbar:
+            for i in range(0, len(rows), chunksize):
+                chunk = rows[i:i + chunksize]
+                cursor_app.executemany(query, map(tuple, chunk))
+                pbar.update(len(chunk))
+        if staged:
+            cursor_app.execute("INSERT OR {} INTO {} ({}) SELECT {} FROM {};".format(
+                conflict, table, column_list, column_list, target))
+            cursor_app.execute("DROP TABLE {};".format(target))
+        conn_app.commit()
+    except sqlite3.Error:
+        conn_app.rollback()
+        raise
+
+    elapsed = time.perf_counter() - started
+    if args.verbose:
+        print("Importate {} righe in {} in {:.2f}s ({:.0f} righe/s){}.".format(
+            len(rows), table, elapsed, len(rows) / elapsed if elapsed else 0, " via staging" if staged else ""))
+    return len(rows)
+
+
+def import_df_in_ts_by_date(df, conflict='IGNORE', file_id=None):
+    # SKU e deposito codificati in blocco con i dizionari, data come numero di giorno
+    if df.empty:
+        return 0
+    df = df.assign(sku_id=encode_column('dizionario_sku', df['sku']),
+                   dep_id=encode_column('dizionario_depositi', df['dep']),
+                   giorno=to_day_numbers(df['data']),
+                   file_id=file_id)
+    return bulk_insert('ts_by_date', df, ('sku_id', 'giorno', 'qta', 'dep_id', 'file_id'), conflict=conflict,
+                desc="Eseguo query importazione in ts_by_date...")
+
+
+def import_df_in_odin_by_date(df, progress=True):
+    # Odin è la fonte di verità: le righe modificate sostituiscono quelle già presenti in odin_righe (stesso
+    # id_odin), i trigger aggiornano la versione attuale in odin_by_date e lo storico.
+    # Il giorno di rilevazione viene salvato a parte per poter fare la join con ts_by_date su indice
+    if df.empty:
+        return 0
+    df = df.assign(sku_id=encode_column('dizionario_sku', df['sku']),
+                   sede_id=encode_column('dizionario_sedi', df['sede']),
+                   luogo_id=encode_column('dizionario_luoghi', df['luogo']),
+                   utente_id=encode_column('dizionario_utenti', df['username']),
+                   giorno=to_day_numbers(df['data']))
+    return bulk_insert('odin_righe', df, odin_columns.split(", "),
+                conflict='REPLACE', datetime_columns=('data', 'ultima_modifica'),
+                desc="Eseguo query importazione in odin_righe...", progress=progress)
+
+
+def import_df_in_corrected(df, conflict='IGNORE', file_id=None):
+    if df.empty:
+        return 0
+    if 'id_odin' not in df.columns:
+        df = df.assign(id_odin=None)  # File esportato prima della colonna id_odin
+    df = df.assign(sku_id=encode_column('dizionario_sku', df['sku']),
+                   sede_id=encode_column('dizionario_sedi', df['sede']),
+                   luogo_id=encode_column('dizionario_luoghi', df['luogo']),
+                   utente_id=encode_column('dizionario_utenti', df['operatore']),
+                   file_id=file_id)
+    rows = bulk_insert('corrected', df, ('id_odin', 'sku_id', 'luogo_id', 'sez', 'sede_id', 'utente_id', 'file_id'),
+                       conflict=conflict, desc="Importo dati di correzione...")
+    resolve_corrected_ids()
+    return rows
+
+
+def resolve_corrected_ids():
+    # Le correzioni senza id_odin prendono quello della rilevazione con la stessa chiave naturale in odin_by_date.
+    # Quelle senza rilevazione corrispondente (ad esempio importate prima di Odin) restano in attesa e vengono
+    # riprovate alla fine di ogni importazione; OR REPLACE assorbe i doppioni di correzioni già risolte.
+    cursor_app.execute("""
+        SELECT c.rowid, o.id_odin
+        FROM corrected c
+        JOIN odin_by_date o ON o.sku_id = c.sku_id AND o.sede_id = c.sede_id AND o.sez = c.sez
+        AND o.luogo_id = c.luogo_id AND o.utente_id = c.utente_id
+        WHERE c.id_odin IS NULL;
+    """)
+    resolved = cursor_app.fetchall()
+    if not resolved:
+        return 0
+    try:
+        cursor_app.executemany("UPDATE OR REPLACE corrected SET id_odin = ? WHERE rowid = ?;",
+                               [(id_odin, rowid) for rowid, id_odin in resolved])
+        conn_app.commit()
+    except sqlite3.Error:
+        conn_app.rollback()
+        raise
+    if args.verbose:
+        print("Risolte {} correzioni senza id_odin.".format(len(resolved)))
+    return len(resolved)
+
+
+# Il confronto lavora sugli id; le join sui dizionari, dopo quella con ts_by_date, decodificano solo le righe
+# che superano il filtro (SQLite valuta ogni condizione appena le tabelle che usa sono disponibili)
+discrepancy_query = """
+    WITH rilevazioni AS (
+        SELECT o.*, SUM(o.qta) OVER (PARTITION BY o.sku_id, o.sede_id) AS totale_qta_rilevata
+        FROM {} o
+        {}
+    )
     SELECT 
-        o.sku,
+        o.id_odin,
+        ds.valore AS sku,
         m.uf_cod,
         m.descrizione,
         o.qta AS qta_rilevata,
-        totale_qta_rilevata.qta AS totale_qta_rilevata,
+        o.totale_qta_rilevata,
         t.qta AS qta_ts,
-        t.qta-totale_qta_rilevata.qta AS discrepanza,
-        o.sede,
-        o.luogo,
+        t.qta-o.totale_qta_rilevata AS discrepanza,
+        dse.valore AS sede,
+        dl.valore AS luogo,
         o.sez,
-        t.dep AS deposito,
+        dd.valore AS deposito,
         o."data" AS data_rilevazione,
-        t."data" AS data_ts,
+        date(t.giorno * 86400, 'unixepoch') AS data_ts,
         o.note AS note_rilevazione,
-        o.username AS operatore
-    FROM odin_by_date o
-    LEFT JOIN products_meta m ON o.sku = m.sku
-    LEFT JOIN ts_by_date t ON t.sku = m.sku AND DATE(t."data") = DATE(o."data") AND t.dep = (CASE WHEN o.sede = "Rende" THEN "00" ELSE "FE" END)
-    LEFT JOIN (
-        SELECT o2.sku, o2.sede, SUM(o2.qta) AS qta
-        FROM odin_by_date o2
-        GROUP BY o2.sku, o2.sede
-        ) AS totale_qta_rilevata ON o.sku = totale_qta_rilevata.sku AND o.sede = totale_qta_rilevata.sede
-    WHERE ((totale_qta_rilevata.qta-t.qta) != 0 OR o.qta IS NULL OR t.qta IS NULL)
-    AND NOT EXISTS (
-        SELECT 1
-        FROM corrected c
-        WHERE o.sku = c.sku
-        AND o.luogo = c.luogo
-        AND o.sez = c.sez
-        AND o.sede = c.sede
-        AND o.username = c.operatore
-    )
+        du.valore AS operatore
+    FROM rilevazioni o
+    LEFT JOIN products_meta m ON o.sku_id = m.sku_id
+    LEFT JOIN sedi_depositi sd ON sd.sede_id = o.sede_id
+    LEFT JOIN ts_by_date t ON t.sku_id = m.sku_id AND t.giorno = o.giorno AND t.dep_id = COALESCE(sd.dep_id, ?)
+    LEFT JOIN dizionario_sku ds ON ds.id = o.sku_id
+    LEFT JOIN dizionario_sedi dse ON dse.id = o.sede_id
+    LEFT JOIN dizionario_luoghi dl ON dl.id = o.luogo_id
+    LEFT JOIN dizionario_utenti du ON du.id = o.utente_id
+    LEFT JOIN dizionario_depositi dd ON dd.id = t.dep_id
+    WHERE ((o.totale_qta_rilevata-t.qta) != 0 OR o.qta IS NULL OR t.qta IS NULL)
+    {}
+    AND NOT EXISTS (SELECT 1 FROM corrected c WHERE c.id_odin = o.id_odin)
     """
-    cursor_app.execute(query)
-    result = cursor_app.fetchall()
-    result = pd.DataFrame.from_records(result, columns=("sku", "uf_cod", "descrizione", "qta_rilevata", "totale_qta_rilevata", "qta_ts", "discrepanza", "sede", "luogo", "sez", "deposito", "data_rilevazione", "data_ts", "note_rilevazione", "operatore"))
+
+
+def get_discrepancy_source():
+    # Rilevazioni confrontate: lo stato attuale (odin_by_date) oppure, con --as-of, l'ultima versione di ogni
+    # rilevazione in odin_storico fino a quella data (le colonne non aggregate vengono dalla riga con MAX)
+    if args.as_of is None:
+        return "odin_by_date", []
+    return """(
+        SELECT id_odin, sku_id, qta, luogo_id, sez, sede_id, data, MAX(giorno) AS giorno, ultima_modifica, note,
+               utente_id
+        FROM odin_storico
+        WHERE giorno <= ?
+        GROUP BY sku_id, sede_id, sez, luogo_id, utente_id
+    )""", [day_number(args.as_of)]
+
+
+def get_discrepancy_source_filter(sku_range=None):
+    # Sorgente e filtro delle rilevazioni (alias o) che entrano nel confronto.
+    # Il totale rilevato è la somma di sku e sede su tutte le date: si tengono solo le sedi richieste
+    # e gli SKU rilevati nel periodo (indice su giorno), il filtro sulle date si applica alle righe del report.
+    # sku_range (inizio, fine): solo gli sku_id dell'intervallo [inizio, fine), vedi calc_discrepancy_parallel.
+    source, source_params = get_discrepancy_source()
+    inner, inner_params = [], []
+    if sku_range is not None:
+        inner.append("o.sku_id >= ? AND o.sku_id < ?")
+        inner_params += list(sku_range)
+    if args.sede:
+        sedi = lookup_ids('dizionario_sedi', args.sede)
+        inner.append("o.sede_id IN ({})".format(",".join("?" * len(sedi))))
+        inner_params += sedi
+    if args.date_from or args.date_to:
+        conditions, params = get_local_filter('r')
+        inner.append("o.sku_id IN (SELECT r.sku_id FROM {} r WHERE {})".format(
+            'odin_by_date' if args.as_of is None else 'odin_storico', " AND ".join(conditions)))
+        inner_params += params
+    return source, "WHERE " + " AND ".join(inner) if inner else "", source_params + inner_params
+
+
+def get_discrepancy_query(sku_range=None):
+    # Query di confronto con i filtri --from/--to/--sede/--deposito
+    source, inner, inner_params = get_discrepancy_source_filter(sku_range)
+    outer, outer_params = [], []
+    if args.date_from or args.date_to:
+        conditions, params = get_local_filter('o', sede=False)
+        outer += conditions
+        outer_params += params
+    if args.deposito:
+        depositi = lookup_ids('dizionario_depositi', args.deposito)
+        outer.append("COALESCE(sd.dep_id, ?) IN ({})".format(",".join("?" * len(depositi))))
+        outer_params += [get_default_dep_id()] + depositi
+    query = discrepancy_query.format(source, inner, "".join("AND {} ".format(c) for c in outer))
+    return query, tuple(inner_params) + (get_default_dep_id(),) + tuple(outer_params)
+
+
+def check_discrepancy_query_plan(query, params=(), name='calc_discrepancy', sources=('o', 'odin_storico'),
+                                 show=False):
+    # EXPLAIN QUERY PLAN: a parte la lettura della tabella che alimenta la query (sources: odin_by_date con alias o
+    # o odin_storico con --as-of) e delle co-routine interne, ogni accesso alle tabelle deve essere una SEARCH su
+    # un indice persistente
+    cursor_app.execute("EXPLAIN QUERY PLAN " + query, params)
+    plan = [row[3] for row in cursor_app.fetchall()]
+    full_scans = []
+    for step in plan:
+        match = re.match(r'SCAN (\S+)', step)
+        if (match and match.group(1) not in sources and not match.group(1).startswith('(')) \
+                or 'AUTOMATIC' in step:
+            full_scans.append(step)
+    if args.verbose or show:
+        print("Piano di esecuzione {}:".format(name))
+        print("\n".join("  " + step for step in plan))
+    if full_scans:
+        print("Attenzione, la query {} esegue scansioni complete: {}".format(name, "; ".join(full_scans)))
+    return not full_scans
+
+
+discrepancy_columns = ("id_odin", "sku", "uf_cod", "descrizione", "qta_rilevata", "totale_qta_rilevata", "qta_ts", "discrepanza",
+                       "sede", "luogo", "sez", "deposito", "data_rilevazione", "data_ts", "note_rilevazione",
+                       "operatore")
+
+
+def read_app_table(query, params, columns):
+    cursor_app.execute(query, params)
+    return pd.DataFrame.from_records(cursor_app.fetchall(), columns=columns)
+
+
+def calc_discrepancy_vectorized():
+    # Stesso risultato di discrepancy_query calcolato in memoria con pandas: le tabelle (già filtrate) vengono
+    # lette una volta, poi somma per (sku, sede), merge hash su (sku, giorno, deposito) e anti-join hash
+    # con le correzioni, tutto sugli id dei dizionari; solo le righe del risultato vengono decodificate.
+    # Restituisce le righe nell'ordine di discrepancy_columns.
+    source, source_filter, params = get_discrepancy_source_filter()
+    o = read_app_table("SELECT o.id_odin, o.sku_id, o.qta, o.luogo_id, o.sez, o.sede_id, o.data, o.giorno, o.note, "
+                       "o.utente_id FROM {} o {};".format(source, source_filter), params,
+                       ("id_odin", "sku_id", "qta", "luogo_id", "sez", "sede_id", "data", "giorno", "note", "utente_id"))
+    o['totale_qta_rilevata'] = o.groupby(['sku_id', 'sede_id'], sort=False)['qta'].transform('sum')
+    if args.date_from:
+        o = o[o['giorno'] >= day_number(args.date_from)]
+    if args.date_to:
+        o = o[o['giorno'] <= day_number(args.date_to)]
+    mapping = dict(read_app_table("SELECT sede_id, dep_id FROM sedi_depositi;", (), ("sede_id", "dep_id")).values)
+    o = o.assign(dep_id=o['sede_id'].map(mapping).fillna(get_default_dep_id()).astype('int64'))
+    if args.deposito:
+        o = o[o['dep_id'].isin(lookup_ids('dizionario_depositi', args.deposito))]
+
+    # Come nella query, i TS si agganciano tramite products_meta (t.sku_id = m.sku_id)
+    meta = read_app_table("SELECT sku_id, uf_cod, descrizione FROM products_meta;", (),
+                          ("sku_id", "uf_cod", "descrizione"))
+    o = o.merge(meta.assign(sku_meta=meta['sku_id'].astype('Int64')), on='sku_id', how='left')
+    ts_conditions, ts_params = [], []
+    if args.date_from:
+        ts_conditions.append("giorno >= ?")
+        ts_params.append(day_number(args.date_from))
+    if args.date_to:
+        ts_conditions.append("giorno <= ?")
+        ts_params.append(day_number(args.date_to))
+    ts = read_app_table("SELECT sku_id, giorno, dep_id, qta FROM ts_by_date {};".format(
+        "WHERE " + " AND ".join(ts_conditions) if ts_conditions else ""), ts_params,
+        ("sku_meta", "giorno", "dep_id", "qta_ts"))
+    ts = ts.assign(sku_meta=ts['sku_meta'].astype('Int64'), deposito_id=ts['dep_id'], giorno_ts=ts['giorno'])
+    o = o.merge(ts, on=['sku_meta', 'giorno', 'dep_id'], how='left')
+    o = o[o['qta_ts'].isna() | (o['totale_qta_rilevata'] != o['qta_ts'])]
+
+    cursor_app.execute("SELECT id_odin FROM corrected WHERE id_odin IS NOT NULL;")
+    corrected = {row[0] for row in cursor_app.fetchall()}
+    if corrected:
+        o = o[~o['id_odin'].isin(corrected)]
+
+    o = o.assign(
+        discrepanza=o['qta_ts'] - o['totale_qta_rilevata'],
+        sku=decode_column('dizionario_sku', o['sku_id']),
+        sede=decode_column('dizionario_sedi', o['sede_id']),
+        luogo=decode_column('dizionario_luoghi', o['luogo_id']),
+        operatore=decode_column('dizionario_utenti', o['utente_id']),
+        deposito=decode_column('dizionario_depositi', o['deposito_id']),
+        data_ts=pd.to_datetime(o['giorno_ts'], unit='D').dt.strftime('%Y-%m-%d'),
+    ).rename(columns={'qta': 'qta_rilevata', 'data': 'data_rilevazione', 'note': 'note_rilevazione'})
+    result = o[list(discrepancy_columns)]
+    for col in ('qta_ts', 'discrepanza'):
+        result = result.assign(**{col: result[col].astype('Int64')})
+    # Valori Python (None al posto di NaN), come le righe lette dal cursore SQLite
+    return result.astype(object).where(result.notna(), None).itertuples(index=False, name=None)
+
+
+partition_conn = None  # Connessione in sola lettura dei processi di calc_discrepancy_parallel
+sqlite_max_integer = 2 ** 63 - 1  # Fine dell'ultimo intervallo di get_discrepancy_partitions
+
+
+def open_partition_connection(path):
+    global partition_conn
+    from pathlib import Path
+    partition_conn = sqlite3.connect(Path(path).resolve().as_uri() + '?mode=ro', uri=True)
+
+
+def calc_discrepancy_partition(query, params):
+    return partition_conn.execute(query, params).fetchall()
+
+
+def get_discrepancy_partitions(count):
+    # Intervalli [inizio, fine) di sku_id con circa lo stesso numero di rilevazioni. Ogni (sku, sede) sta
+    # in un solo intervallo, quindi i totali rilevati di ogni partizione sono completi; odin_by_date e
+    # l'indice chiave di odin_storico sono ordinati per sku_id, così ogni partizione legge solo le sue pagine.
+    # Un solo passaggio ordinato sulle righe per SKU (da totali_rilevati, con --as-of dall'indice chiave di
+    # odin_storico): ogni partizione inizia dal primo SKU oltre la sua quota di righe. Il primo e l'ultimo
+    # intervallo sono aperti: le rilevazioni sono tutte coperte anche con conteggi inesatti.
+    if args.as_of is None:
+        total_query = "SELECT SUM(righe) FROM totali_rilevati;"
+        counts_query = "SELECT sku_id, SUM(righe) FROM totali_rilevati GROUP BY sku_id;"
+    else:
+        total_query = "SELECT COUNT(*) FROM odin_storico;"
+        counts_query = "SELECT sku_id, COUNT(*) FROM odin_storico GROUP BY sku_id;"
+    cursor_app.execute(total_query)
+    total = cursor_app.fetchone()[0] or 0
+    bounds, seen = [0], 0
+    for sku_id, rows in conn_app.execute(counts_query):
+        if len(bounds) < count and seen * count >= len(bounds) * total:
+            bounds.append(sku_id)
+        seen += rows
+    bounds.append(sqlite_max_integer)
+    return list(zip(bounds, bounds[1:]))
+
+
+def calc_discrepancy_parallel(partitions_per_worker=4):
+    # discrepancy_query eseguita per intervalli di sku_id, in un pool di --workers processi con connessioni
+    # in sola lettura. I risultati vengono restituiti nell'ordine degli intervalli: stesse righe del motore
+    # sql, nello stesso ordine (la query legge le rilevazioni in ordine di sku_id).
+    workers = max(args.workers, 1)
+    partitions = get_discrepancy_partitions(workers * partitions_per_worker if workers > 1 else 1)
+    queries = [get_discrepancy_query(sku_range) for sku_range in partitions]
+    check_discrepancy_query_plan(*queries[0])
+    if workers <= 1:
+        for query, params in queries:
+            yield from conn_app.execute(query, params)
+        return
+    conn_app.commit()  # I processi vedono solo i dati salvati
+    with ProcessPoolExecutor(max_workers=min(workers, len(queries)), mp_context=multiprocessing.get_context('spawn'),
+                             initializer=open_partition_connection, initargs=(database,)) as executor:
+        for rows in executor.map(calc_discrepancy_partition, *zip(*queries)):
+            yield from rows
+
+
+# Ricalcolo in discrepanze degli SKU in discrepanze_sku_modificati: stessa logica di discrepancy_query,
+# con il totale rilevato letto da totali_rilevati invece che dalla funzione finestra.
+# CROSS JOIN fissa l'ordine: si parte dagli SKU modificati, mai da una scansione di odin_by_date.
+refresh_discrepancy_query = """
+    INSERT INTO discrepanze
+    SELECT
+        o.id_odin,
+        ds.valore,
+        m.uf_cod,
+        m.descrizione,
+        o.qta,
+        tr.totale,
+        t.qta,
+        t.qta-tr.totale,
+        dse.valore,
+        dl.valore,
+        o.sez,
+        dd.valore,
+        o."data",
+        date(t.giorno * 86400, 'unixepoch'),
+        o.note,
+        du.valore,
+        o.sku_id,
+        o.sede_id,
+        o.giorno,
+        COALESCE(sd.dep_id, ?)
+    FROM discrepanze_sku_modificati d
+    CROSS JOIN odin_by_date o ON o.sku_id = d.sku_id
+    CROSS JOIN totali_rilevati tr ON tr.sku_id = o.sku_id AND tr.sede_id = o.sede_id
+    LEFT JOIN products_meta m ON o.sku_id = m.sku_id
+    LEFT JOIN sedi_depositi sd ON sd.sede_id = o.sede_id
+    LEFT JOIN ts_by_date t ON t.sku_id = m.sku_id AND t.giorno = o.giorno AND t.dep_id = COALESCE(sd.dep_id, ?)
+    LEFT JOIN dizionario_sku ds ON ds.id = o.sku_id
+    LEFT JOIN dizionario_sedi dse ON dse.id = o.sede_id
+    LEFT JOIN dizionario_luoghi dl ON dl.id = o.luogo_id
+    LEFT JOIN dizionario_utenti du ON du.id = o.utente_id
+    LEFT JOIN dizionario_depositi dd ON dd.id = t.dep_id
+    WHERE ((tr.totale-t.qta) != 0 OR o.qta IS NULL OR t.qta IS NULL)
+    AND NOT EXISTS (SELECT 1 FROM corrected c WHERE c.id_odin = o.id_odin);
+    """
+
+
+def refresh_discrepancy():
+    # Il costo dipende dagli SKU modificati dall'ultimo aggiornamento, non dalla dimensione dello storico
+    cursor_app.execute("SELECT COUNT(*) FROM discrepanze_sku_modificati;")
+    modified = cursor_app.fetchone()[0]
+    if not modified:
+        return 0
+    with Span('aggiornamento_discrepanze') as span:
+        try:
+            cursor_app.execute("DELETE FROM discrepanze WHERE sku_id IN (SELECT sku_id FROM discrepanze_sku_modificati);")
+            cursor_app.execute(refresh_discrepancy_query, (get_default_dep_id(), get_default_dep_id()))
+            span.rows = cursor_app.rowcount
+            cursor_app.execute("DELETE FROM discrepanze_sku_modificati;")
+            conn_app.commit()
+        except sqlite3.Error:
+            conn_app.rollback()
+            raise
+    if args.verbose:
+        print("Confronto aggiornato per {} SKU modificati.".format(modified))
+    return modified
+
+
+def explain_discrepancy():
+    # --explain: piano di entrambe le query del confronto, qualunque sia il motore e anche senza -p o esportazione.
+    # refresh_discrepancy_query parte dagli SKU modificati (alias d), l'unica tabella che può leggere per intero.
+    ok = check_discrepancy_query_plan(*get_discrepancy_query(), show=True)
+    ok = check_discrepancy_query_plan(refresh_discrepancy_query, (get_default_dep_id(), get_default_dep_id()),
+                                      'refresh_discrepancy', ('d',), show=True) and ok
+    if not ok:
+        print("Errore: il piano di esecuzione del confronto contiene scansioni complete.")
+        exit(1)
+
+
+def rebuild_discrepancy_totals():
+    # Totali ricalcolati da odin_by_date e tutti gli SKU da aggiornare; riattiva i trigger su odin_by_date
+    cursor_app.execute("DELETE FROM totali_rilevati;")
+    cursor_app.execute("INSERT INTO totali_rilevati (sku_id, sede_id, totale, righe) "
+                       "SELECT sku_id, sede_id, SUM(qta), COUNT(*) FROM odin_by_date GROUP BY sku_id, sede_id;")
+    cursor_app.execute("DELETE FROM discrepanze;")
+    cursor_app.execute("INSERT OR IGNORE INTO discrepanze_sku_modificati (sku_id) "
+                       "SELECT DISTINCT sku_id FROM odin_by_date;")
+    cursor_app.execute("DELETE FROM caricamento_massivo;")
+    conn_app.commit()
+
+
+def rebuild_discrepancy():
+    # Ricostruzione completa (--rebuild-discrepancy)
+    rebuild_discrepancy_totals()
+    refresh_discrepancy()
+
+
+def begin_odin_bulk_load():
+    # Sincronizzazione completa in odin_righe vuota: rilevazioni attuali, storico e totali aggiornati riga per riga
+    # dai trigger costerebbero più del caricamento stesso, quindi i trigger restano fermi e le tabelle derivate si
+    # calcolano una volta sola a fine caricamento. La riga in caricamento_massivo è persistente: se il caricamento
+    # si interrompe, end_odin_bulk_load viene chiamata dalla prossima importazione (vedi run_imports).
+    cursor_app.execute("SELECT EXISTS (SELECT 1 FROM odin_righe);")
+    if not cursor_app.fetchone()[0]:
+        cursor_app.execute("INSERT OR IGNORE INTO caricamento_massivo (fonte) VALUES ('odin_righe');")
+        conn_app.commit()
+
+
+def end_odin_bulk_load():
+    cursor_app.execute("SELECT EXISTS (SELECT 1 FROM caricamento_massivo);")
+    if not cursor_app.fetchone()[0]:
+        return
+    with Span('fine_caricamento_massivo'):
+        # Versione attuale di ogni rilevazione, come nel trigger trg_odin_righe_ins
+        cursor_app.execute("DELETE FROM odin_by_date;")
+        cursor_app.execute("""
+            INSERT INTO odin_by_date ({0})
+            SELECT {0} FROM (
+                SELECT *, ROW_NUMBER() OVER (
+                    PARTITION BY sku_id, sede_id, sez, luogo_id, utente_id ORDER BY giorno DESC, id_odin DESC
+                ) AS versione
+                FROM odin_righe
+            )
+            WHERE versione = 1
+            ORDER BY sku_id, sede_id, sez, luogo_id, utente_id;
+        """.format(odin_columns))
+        # Storico da tutte le righe scaricate, non dalle sole versioni attuali: una versione per giorno di ogni
+        # rilevazione (id_odin più alto), come nel trigger trg_odin_righe_ins
+        cursor_app.execute("DELETE FROM odin_storico;")
+        cursor_app.execute("""
+            INSERT INTO odin_storico ({0})
+            SELECT {0} FROM (
+                SELECT *, ROW_NUMBER() OVER (
+                    PARTITION BY giorno, sede_id, sku_id, sez, luogo_id, utente_id ORDER BY id_odin DESC
+                ) AS versione
+                FROM odin_righe
+            )
+            WHERE versione = 1
+            ORDER BY giorno, sede_id, sku_id, sez, luogo_id, utente_id;
+        """.format(odin_columns))
+        rebuild_discrepancy_totals()
+
+
+def get_materialized_discrepancy_query():
+    # Lettura della tabella discrepanze con i filtri --from/--to/--sede/--deposito
+    conditions, params = get_local_filter('d')
+    if args.deposito:
+        depositi = lookup_ids('dizionario_depositi', args.deposito)
+        conditions.append("d.dep_sede_id IN ({})".format(",".join("?" * len(depositi))))
+        params += depositi
+    query = "SELECT {} FROM discrepanze d {};".format(
+        ", ".join(discrepancy_columns), "WHERE " + " AND ".join(conditions) if conditions else "")
+    return query, params
+
+
+def get_discrepancy_engine():
+    if args.engine == 'materialized' and args.as_of is not None:
+        return 'sql'  # Lo storico (--as-of) non è materializzato
+    return args.engine
+
+
+def iter_discrepancy_engine(batchsize=10000):
+    # Righe del confronto lette dal cursore a blocchi, senza caricarle tutte in memoria
+    engine = get_discrepancy_engine()
+    if engine == 'vectorized':
+        yield from calc_discrepancy_vectorized()
+        return
+    if engine == 'parallel':
+        yield from calc_discrepancy_parallel()
+        return
+    if engine == 'materialized':
+        refresh_discrepancy()
+        query, params = get_materialized_discrepancy_query()
+    else:
+        query, params = get_discrepancy_query()
+        check_discrepancy_query_plan(query, params)
+    cursor = conn_app.cursor()
+    cursor.execute(query, params)
+    while True:
+        rows = cursor.fetchmany(batchsize)
+        if not rows:
+            break
+        yield from rows
+    cursor.close()
+
+
+def iter_discrepancy(batchsize=10000):
+    # Righe del confronto dalla cache dei risultati se dati e parametri non sono cambiati, altrimenti dal motore
+    # (e scritte in cache mentre vengono prodotte)
+    cache_path = get_result_cache_path()
+    rows = read_result_cache(cache_path)
+    if rows is None:
+        rows = write_result_cache(cache_path, iter_discrepancy_engine(batchsize))
+    yield from rows
+
+
+def calc_discrepancy():
+    with Span('confronto') as span:
+        cache_path = get_result_cache_path()
+        result = read_result_cache(cache_path, as_frame=True)
+        if result is None:
+            rows = write_result_cache(cache_path, iter_discrepancy_engine())
+            result = pd.DataFrame.from_records(list(rows), columns=discrepancy_columns)
+        span.rows = len(result)
+    return result
+
+
+def report_discrepancy():
+    if args.explain:
+        explain_discrepancy()
+    result = None
     if args.print_results:
-        pretty_result = result # Formatta meglio i risultati per la console
-        pretty_result['descrizione'] = pretty_result['descrizione'].apply(lambda desc: desc[:50] + "..." if len(desc)>50 else desc)
+        result = calc_discrepancy()
+        pretty_result = result.copy() # Formatta meglio i risultati per la console
+        pretty_result['descrizione'] = pretty_result['descrizione'].apply(
+            lambda desc: desc[:50] + "..." if isinstance(desc, str) and len(desc)>50 else desc)
+        from tabulate import tabulate
         print(tabulate(pretty_result, headers='keys', tablefmt='psql'))
-    # Chiedi se si vuole esportazione
-    response = input("Vuoi esportare questo confronto in un file (Excel) (s/N): ").strip().lower()
-    if response == 's':
-        export_as_excel(result)
+    # Chiedi se si vuole esportazione (--export/--no-export rispondono senza chiedere)
+    export = args.export
+    if export is None:
+        try:
+            response = input("Vuoi esportare questo confronto in un file ({}) (s/N): ".format(args.export_format))
+        except EOFError:
+            response = ''  # Nessun input disponibile (esecuzione pianificata): niente esportazione
+        export = response.strip().lower() == 's'
+    if export:
+        if result is not None:
+            rows = result.astype(object).where(result.notna(), None).itertuples(index=False, name=None)
+        else:
+            rows = iter_discrepancy()  # Esportazione in streaming direttamente dal cursore
+        with Span('esportazione') as span:
+            export_discrepancy(count_rows(rows, span), args.export_format, args.split_sede)
         print("Esportazione completata.")
 
 # end region
@@ -398,9 +2178,28 @@ def extract_date_from_filename(name):
         return None
 
 
+def get_excel_engine():
+    if args.excel_engine == 'auto':
+        return 'calamine' if importlib.util.find_spec('python_calamine') else 'openpyxl'
+    return args.excel_engine
+
+
 # Funzione per estrarre i dati da excel
 def get_xlsx_as_df(file, table):
-    df = pd.read_excel(file)
+    columns = xlsx_columns.get(table)
+    optional_columns = xlsx_optional_columns.get(table, [])
+    # Con colonne facoltative usecols è una funzione, che non segnala le colonne mancanti: il controllo è sotto
+    usecols = (lambda col: col in columns) if optional_columns else columns
+    try:
+        df = pd.read_excel(file, engine=get_excel_engine(), usecols=usecols)
+    except ValueError as e:
+        # usecols solleva ValueError se nel file manca una delle colonne richieste
+        print(f"Errore: Colonne mancanti nel file {file} ({e})")
+        return
+    missing = [col for col in columns or [] if col not in df.columns and col not in optional_columns]
+    if missing:
+        print(f"Errore: Colonne mancanti nel file {file} ({', '.join(missing)})")
+        return
     required_columns = {}
 
     if table == "ts":
@@ -432,139 +2231,721 @@ def get_xlsx_as_df(file, table):
     elif table == 'odin':
         pass
 
-    df = df[list(required_columns)]
+    present_optional = [col for col in optional_columns if col in df.columns]
+    df = df[list(required_columns) + present_optional]
+    if 'id_odin' in present_optional:
+        df = df.assign(id_odin=df['id_odin'].astype('Int64'))
 
-    # Controlla stato di salute del DataFrame e prova a correggerlo
-    if df.isnull().any().any():
+    # Controlla stato di salute del DataFrame e prova a correggerlo (le colonne facoltative possono essere vuote)
+    invalid = df[list(required_columns)].isnull().any(axis=1)
+    if invalid.any():
         if args.verbose:
             print("Attenzione, queste righe NON sono valide:")
-            print(df[df.isnull().any(axis=1)])
-        df = df.dropna()
+            print(df[invalid])
+        df = df[~invalid]
 
     if not required_columns.issubset(df.columns):
-        print("Errore: Colonne mancanti nel file {file}")
+        print(f"Errore: Colonne mancanti nel file {file}")
         return
     return df
 
-def export_as_excel(df, path=excel_export_path):
-    filename = os.path.join(path, "Confronto Inventario del {}.xlsx".format(datetime.now().strftime("%d-%m-%Y %H-%M")))
-    os.makedirs(path, exist_ok=True) # Crea cartella se non esiste
-    with pd.ExcelWriter(filename, engine='xlsxwriter') as writer:
-        df.insert(0, "Corretto", "") # Aggiungi una colonna nell'indice 0 per tenere traccia delle correzioni effettuate, verrà poi usato per aggiornare il db
-        df.to_excel(writer, index=False, sheet_name="Confronto")
 
-        # Ottieni l'oggetto workbook e worksheet per applicare le formattazioni
-        workbook = writer.book
-        worksheet = writer.sheets["Confronto"]
+# region Cache file Excel
+# I DataFrame già puliti vengono salvati in dir_parse_cache con chiave tabella + nome file + sha256 del contenuto
+# + formato (parse_cache_version e colonne lette, vedi get_parse_cache_path).
+# index.json ricorda per ogni percorso mtime, dimensione e hash, così i file non modificati non vengono riletti
+# per calcolare l'hash.
+def load_parse_cache_index():
+    try:
+        with open(os.path.join(dir_parse_cache, 'index.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_parse_cache_index(index):
+    os.makedirs(dir_parse_cache, exist_ok=True)
+    tmp_path = os.path.join(dir_parse_cache, 'index.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, os.path.join(dir_parse_cache, 'index.json'))
+
+
+def get_file_hash(path, index):
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    cached = index.get(key)
+    if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+        return cached[2]
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    index[key] = [stat.st_mtime_ns, stat.st_size, sha.hexdigest()]
+    return sha.hexdigest()
+
+
+def get_parse_cache_path(table, path, file_hash):
+    # Nei file TS la data viene dal nome del file: il nome fa parte della chiave. Anche versione del formato
+    # e colonne lette ne fanno parte: le voci scritte da una versione precedente dello script non vengono lette.
+    name_hash = hashlib.sha256(os.path.basename(path).encode()).hexdigest()[:12]
+    parse_format = json.dumps([parse_cache_version, xlsx_columns.get(table), xlsx_optional_columns.get(table)])
+    format_hash = hashlib.sha256(parse_format.encode()).hexdigest()[:12]
+    extension = 'parquet' if importlib.util.find_spec('pyarrow') else 'pkl'
+    return os.path.join(dir_parse_cache, "{}-{}-{}-{}.{}".format(table, file_hash, name_hash, format_hash, extension))
+
+
+def read_parse_cache(cache_path):
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        df = pd.read_parquet(cache_path) if cache_path.endswith('.parquet') else pd.read_pickle(cache_path)
+    except Exception as e:
+        print("Cache {} non leggibile, rileggo il file Excel. ({})".format(cache_path, e))
+        return None
+    os.utime(cache_path)  # La data di modifica segna l'ultimo utilizzo per l'eviction
+    return df
 
-        # Applica una larghezza alle colonne per migliorare la leggibilità
-        for i, col in enumerate(df.columns):
-            max_length = max(df[col].astype(str).map(len).max(), len(col)) + 2
-            worksheet.set_column(i, i, max_length)
 
-        # Formatta l'intestazione
-        header_format = workbook.add_format(
-            {'bold': True, 'text_wrap': True, 'valign': 'center', 'fg_color': '#D7E4BC', 'border': 1})
-        for col_num, value in enumerate(df.columns.values):
-            worksheet.write(0, col_num, value, header_format)
+def write_parse_cache(cache_path, df):
+    os.makedirs(dir_parse_cache, exist_ok=True)
+    tmp_path = cache_path + '.tmp'
+    if cache_path.endswith('.parquet'):
+        df.to_parquet(tmp_path, index=False)
+    else:
+        df.to_pickle(tmp_path)
+    os.replace(tmp_path, cache_path)
 
-# end region
-# region Esecuzione
-# Connessione al database SQLite (DB app)
-if args.reset:
-    try:
-        os.remove(database)
-    except Exception as e:
-        print(e)
-        exit(1)
 
-conn_app = sqlite3.connect(database)
-cursor_app = conn_app.cursor()
+def evict_parse_cache(max_bytes):
+    # Elimina i file usati meno di recente finché la cache non rientra nel limite
+    if not os.path.isdir(dir_parse_cache):
+        return
+    entries = []
+    for name in os.listdir(dir_parse_cache):
+        if name == 'index.json':
+            continue
+        path = os.path.join(dir_parse_cache, name)
+        stat = os.stat(path)
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(e[1] for e in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        total -= size
+        if args.verbose:
+            print("Cache: rimosso {}".format(path))
+# endregion
 
-# Connessione al database remoto odin MariaDB
-tunnel_odin, conn_odin = connect_db_odin()
-cursor_odin = conn_odin.cursor()
 
-# Cache
-total_rows_odin = 0
-imported_ts_files = []
-imported_corrected_files = []
+def parse_xlsx_files(paths, table):
+    # Legge i file in un pool di processi e restituisce (percorso, DataFrame) man mano che sono pronti;
+    # la scrittura su SQLite resta nel processo principale.
+    # I processi vengono avviati con spawn: il pool può partire da un thread di run_stages
+    # e un fork con altri thread attivi non è sicuro.
+    workers = min(args.workers, len(paths))
+    if workers <= 1:
+        for path in paths:
+            yield path, get_xlsx_as_df(path, table)
+        return
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {executor.submit(get_xlsx_as_df, path, table): path for path in paths}
+        for future in as_completed(futures):
+            # Il future viene tolto dal dizionario: il DataFrame resta in memoria solo finché serve al chiamante
+            yield futures.pop(future), future.result()
+
+
+def write_xlsx_frame(file_type, file_path, df, file_hash, changed, position, total, import_function,
+                     frame_filter=None):
+    print("Importo file {}/{}".format(position, total))
+    if df is None:
+        return  # Il file verrà riprovato alla prossima esecuzione
+    if frame_filter is not None:
+        # Importato solo in parte: senza hash il file viene completato (con REPLACE) alla prossima esecuzione
+        df = frame_filter(df)
+        file_hash = None
+    file_id = get_imported_file_id(file_type, os.path.basename(file_path))
+    if changed:
+        # Un file modificato sostituisce i dati importati in precedenza: le sue righe vengono tolte prima
+        # dell'importazione (nella stessa transazione), così spariscono anche quelle tolte dal file. Ogni riga
+        # appartiene all'ultimo file che l'ha scritta (una data può essere divisa tra più file).
+        cursor_app.execute("DELETE FROM {} WHERE file_id = ?;".format(file_type), (file_id,))
+    rows = import_function(df, conflict='REPLACE' if changed else 'IGNORE', file_id=file_id)
+    insert_imported_file(file_type, os.path.basename(file_path), file_hash)
+    return rows
+
+
+def ts_file_in_range(filename):
+    # --from/--to: i file TS fuori dal periodo non vengono letti (né segnati come importati)
+    data_date = extract_date_from_filename(filename)
+    if data_date is None:
+        return True  # L'errore viene segnalato in lettura
+    return ((args.date_from is None or data_date >= args.date_from)
+            and (args.date_to is None or data_date <= args.date_to))
+
+
+def get_ts_frame_filter():
+    # --deposito/--sede: dai file TS si importano solo le righe dei depositi richiesti
+    depositi = get_filter_depositi()
+    if depositi is None:
+        return None
+    return lambda df: df[df['dep'].astype(str).isin(depositi)]
 
-if not os.path.exists(database) or args.reset:
-    init_app_db()
 
-#region Importazioni
-# Iterazione su tutti i file Excel nelle directory
-# TS
-if not args.skip_ts:
-    if args.verbose:
-        print(f"Importo file excel da {dir_ts_file_by_date}")
-    files = os.listdir(dir_ts_file_by_date)
-    imported_ts_files = get_imported_files('ts_by_date')
-
-    for i, filename in enumerate(files):
-        print("Importo file {}/{}".format(i + 1, len(files)))
-        if filename.endswith('.xlsx'):
-            if filename in imported_ts_files:
-                if args.verbose:
-                    print("File {} saltato.".format(filename))
-                continue
-            file_path = os.path.join(dir_ts_file_by_date, filename)
-            import_df_in_ts_by_date(get_xlsx_as_df(file_path, 'ts'))
-            insert_imported_file('ts_by_date', filename)
+def xlsx_import_actions(directory, file_type, table, import_function, file_filter=None, frame_filter=None):
+    # Il confronto con imported_files avviene subito; il generatore restituito legge i file
+    # (cache o pool di processi) e produce le scritture da eseguire sul thread principale.
+    # file_filter(nome) esclude file interi, frame_filter(df) le righe da non importare.
     if args.verbose:
-        print("Dati importati in ts_by_date.")
-else:
-    if args.verbose:
-        print("Salto importazione file TS. (--skip-ts)")
-
-# Odin
-if not args.skip_odin:
-    total_rows_odin = get_odin_inventario_completo_total_rows()
-    odin_df = pd.DataFrame()
-    for batch in get_odin_inventario_completo_as_df(3):
-        odin_df = pd.concat([odin_df, batch], ignore_index=True)
-    import_df_in_odin_by_date(odin_df)
-else:
-    if args.skip_odin:
-        print("Salto importazione Odin. (--skip-odin)")
-
-# Meta
-if not args.skip_prod_meta:
-    transfer_missing_products_meta_to_local_db()
-else:
-    print("Salto importazione Meta Prodotti. (--skip-prod-meta)")
-
-# Corrected
-if not args.skip_corrected:
-    if args.verbose:
-        print(f"Importo file excel da {dir_corrected_file}")
-    files = os.listdir(dir_corrected_file)
-    imported_corrected_files = get_imported_files('corrected')
-
-    for i, filename in enumerate(files):
-        print("Importo file {}/{}".format(i + 1, len(files)))
-        if filename.endswith('.xlsx'):
-            if filename in imported_corrected_files:
+        print(f"Importo file excel da {directory}")
+    imported_files = get_imported_files(file_type)
+    cache_index = {} if args.no_cache else load_parse_cache_index()  # Con --no-cache cache_xlsx non viene toccata
+    files = [f for f in sorted(os.listdir(directory)) if f.endswith('.xlsx')]
+    to_import = []
+    for filename in files:
+        if file_filter is not None and not file_filter(filename):
+            if args.verbose:
+                print("File {} escluso dai filtri.".format(filename))
+            continue
+        file_path = os.path.join(directory, filename)
+        file_hash = get_file_hash(file_path, cache_index)
+        if imported_files.get(filename) == file_hash:
+            if args.verbose:
+                print("File {} saltato.".format(filename))
+            continue
+        if filename in imported_files and imported_files[filename] is None:
+            if args.verbose:
+                print("Il file {} era stato importato solo in parte, lo reimporto.".format(filename))
+        elif filename in imported_files:
+            print("Il file {} è cambiato dall'ultima importazione, lo reimporto.".format(filename))
+        to_import.append((file_path, file_hash))
+    if not args.no_cache:
+        save_parse_cache_index(cache_index)
+
+    def parsed_frames():
+        # Prima i file già presenti in cache, poi quelli da leggere (in parallelo)
+        to_parse = {}
+        for file_path, file_hash in to_import:
+            cache_path = get_parse_cache_path(table, file_path, file_hash)
+            df = None if args.no_cache else read_parse_cache(cache_path)
+            if df is not None:
                 if args.verbose:
-                    print("File {} saltato.".format(filename))
-                continue
-            file_path = os.path.join(dir_corrected_file, filename)
-            import_df_in_corrected(get_xlsx_as_df(file_path, 'corrected'))
-            insert_imported_file('corrected', filename)
-    if args.verbose:
-        print("Dati importati in corrected.")
-else:
+                    print("File {} letto dalla cache.".format(os.path.basename(file_path)))
+                yield file_path, df
+            else:
+                to_parse[file_path] = cache_path
+        for file_path, df in parse_xlsx_files(list(to_parse), table):
+            if df is not None and not args.no_cache:
+                write_parse_cache(to_parse[file_path], df)
+            yield file_path, df
+
+    def actions():
+        hashes = dict(to_import)
+        for i, (file_path, df) in enumerate(parsed_frames()):
+            changed = os.path.basename(file_path) in imported_files
+            yield functools.partial(write_xlsx_frame, file_type, file_path, df, hashes[file_path], changed,
+                                    i + 1, len(to_import), import_function, frame_filter)
+        if not args.no_cache:
+            evict_parse_cache(args.cache_max_mb * 1024 * 1024)
+
+    return actions()
+
+
+# region Esportazione
+# Le esportazioni ricevono un iterabile di righe (tuple nell'ordine di discrepancy_columns) e le scrivono
+# una alla volta. La prima colonna "Corretto" resta vuota: serve per segnare le correzioni effettuate,
+# verrà poi usata per aggiornare il db.
+export_columns = ("Corretto",) + discrepancy_columns
+parquet_column_types = {
+    "id_odin": 'int64', "qta_rilevata": 'int64', "totale_qta_rilevata": 'int64', "qta_ts": 'int64', "discrepanza": 'int64',
+    "sez": 'int64',
+}
+
+
+def export_as_excel(rows, filename, sample_size=1000):
+    import xlsxwriter
+    workbook = xlsxwriter.Workbook(filename, {'constant_memory': True})
+    worksheet = workbook.add_worksheet("Confronto")
+
+    # Larghezza delle colonne stimata sulle prime sample_size righe
+    rows = iter(rows)
+    sample = list(itertools.islice(rows, sample_size))
+    for i, col in enumerate(export_columns):
+        values = [len(str(row[i - 1])) for row in sample if i > 0 and row[i - 1] is not None]
+        worksheet.set_column(i, i, max(values + [len(col)]) + 2)
+
+    # Formatta l'intestazione
+    header_format = workbook.add_format(
+        {'bold': True, 'text_wrap': True, 'valign': 'center', 'fg_color': '#D7E4BC', 'border': 1})
+    for col_num, value in enumerate(export_columns):
+        worksheet.write(0, col_num, value, header_format)
+
+    # In constant_memory le righe vanno scritte in ordine, ognuna viene scaricata su disco appena completata
+    for row_num, row in enumerate(itertools.chain(sample, rows), start=1):
+        for col_num, value in enumerate(row, start=1):
+            if value is not None:
+                worksheet.write(row_num, col_num, value)
+    workbook.close()
+
+
+def export_as_csv(rows, filename):
+    with open(filename, 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.writer(f)
+        writer.writerow(export_columns)
+        for row in rows:
+            writer.writerow(("",) + tuple(row))
+
+
+def get_parquet_schema(columns):
+    import pyarrow as pa
+    return pa.schema([(col, pa.int64() if parquet_column_types.get(col) == 'int64' else pa.string())
+                      for col in columns])
+
+
+def rows_to_parquet_table(batch, schema):
+    # Righe (tuple nell'ordine dello schema) come tabella pyarrow, colonne intere o di testo
+    import pyarrow as pa
+    columns = [list(col) for col in zip(*batch)]
+    columns = [col if parquet_column_types.get(name) else [None if v is None else str(v) for v in col]
+               for name, col in zip(schema.names, columns)]
+    return pa.Table.from_arrays([pa.array(col, type=field.type) for col, field in zip(columns, schema)],
+                                schema=schema)
+
+
+def export_as_parquet(rows, filename, batchsize=50000):
+    import pyarrow.parquet as pq
+    schema = get_parquet_schema(export_columns)
+    rows = iter(rows)
+    with pq.ParquetWriter(filename, schema) as writer:
+        while True:
+            batch = list(itertools.islice(rows, batchsize))
+            if not batch:
+                break
+            writer.write_table(rows_to_parquet_table([(None,) + tuple(row) for row in batch], schema))
+
+
+def export_discrepancy(rows, formato='xlsx', split_sede=False, path=excel_export_path):
+    export_functions = {'xlsx': export_as_excel, 'csv': export_as_csv, 'parquet': export_as_parquet}
+    name = "Confronto Inventario del {}".format(datetime.now().strftime("%d-%m-%Y %H-%M"))
+    os.makedirs(path, exist_ok=True) # Crea cartella se non esiste
+    if not split_sede:
+        export_functions[formato](rows, os.path.join(path, "{}.{}".format(name, formato)))
+        return
+
+    # Un file per sede: ogni sede ha il suo writer in un thread, alimentato da una coda,
+    # così le righe vengono distribuite in un solo passaggio senza ordinarle
+    sede_index = discrepancy_columns.index("sede")
+    feeds, threads, errors = {}, [], []
+
+    def write_sede(feed, filename):
+        # Un writer che fallisce (es. disco pieno) continua a svuotare la sua coda, così il thread principale
+        # non resta bloccato su put; l'errore viene rilanciato dal thread principale
+        try:
+            export_functions[formato](feed, filename)
+        except BaseException as e:
+            errors.append(e)
+            for _ in feed:
+                pass
+
+    try:
+        for row in rows:
+            if errors:
+                break
+            sede = row[sede_index] or "Senza sede"
+            if sede not in feeds:
+                feeds[sede] = queue.Queue(maxsize=1000)
+                filename = os.path.join(path, "{} - {}.{}".format(name, re.sub(r'[\\/:*?"<>|]', '_', sede), formato))
+                feed = iter(feeds[sede].get, None)
+                thread = threading.Thread(target=write_sede, args=(feed, filename))
+                thread.start()
+                threads.append(thread)
+            feeds[sede].put(row)
+    finally:
+        for feed in feeds.values():
+            feed.put(None)
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+# endregion
+
+# region Cache confronto
+# Il risultato del confronto viene salvato in dir_result_cache (Parquet) con chiave versione dei dati + motore e
+# filtri. La versione dei dati comprende file importati, watermark delle sincronizzazioni e versioni delle tabelle
+# lette dal confronto: ogni importazione che cambia i dati cambia la chiave, quindi le voci non vanno mai
+# invalidate, solo eliminate quando sono più di --result-cache-entries.
+def get_data_fingerprint():
+    # Le tabelle segnate dai trigger passano alla versione successiva
+    cursor_app.execute("UPDATE versioni_dati SET versione = versione + 1 "
+                       "WHERE tabella IN (SELECT tabella FROM versioni_dati_modificate);")
+    cursor_app.execute("DELETE FROM versioni_dati_modificate;")
+    conn_app.commit()
+    sha = hashlib.sha256()
+    for query in ("SELECT tabella, versione FROM versioni_dati ORDER BY tabella;",
+                  "SELECT type, nome, hash FROM imported_files ORDER BY type, nome;",
+                  "SELECT fonte, ultima_modifica, id_odin FROM sync_watermark ORDER BY fonte;"):
+        cursor_app.execute(query)
+        sha.update(json.dumps(cursor_app.fetchall(), default=str).encode())
+    return sha.hexdigest()
+
+
+def get_result_cache_path():
+    # None se la cache non si usa: disattivata, senza pyarrow o con --explain (il piano richiede la query)
+    if args.result_cache_entries <= 0 or args.explain or not importlib.util.find_spec('pyarrow'):
+        return None
+    key = {'dati': get_data_fingerprint(), 'schema': schema_version, 'motore': get_discrepancy_engine(),
+           'from': args.date_from, 'to': args.date_to, 'sede': sorted(args.sede or ()),
+           'deposito': sorted(args.deposito or ()), 'as_of': args.as_of, 'deposito_default': deposito_default}
+    name = hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()[:32]
+    return os.path.join(dir_result_cache, name + '.parquet')
+
+
+def read_result_cache(cache_path, as_frame=False, batchsize=50000):
+    # DataFrame (as_frame) o righe in streaming del confronto in cache; None se la voce non c'è
+    if cache_path is None or not os.path.exists(cache_path):
+        return None
+    import pyarrow.parquet as pq
+    try:
+        if as_frame:
+            result = pd.read_parquet(cache_path)
+        else:
+            parquet_file = pq.ParquetFile(cache_path)
+            result = (row for batch in parquet_file.iter_batches(batch_size=batchsize)
+                      for row in zip(*(column.to_pylist() for column in batch.columns)))
+    except Exception as e:
+        print("Cache {} non leggibile, ricalcolo il confronto. ({})".format(cache_path, e))
+        return None
+    os.utime(cache_path)  # La data di modifica segna l'ultimo utilizzo per l'eviction
     if args.verbose:
-        print("Salto importazione file Corrected. (--skip-corrected)")
+        print("Confronto letto dalla cache dei risultati ({}).".format(cache_path))
+    return result
 
+
+def write_result_cache(cache_path, rows, batchsize=50000):
+    # Restituisce le righe scrivendole in cache a blocchi; la voce viene pubblicata solo se le righe
+    # sono state lette tutte
+    if cache_path is None:
+        yield from rows
+        return
+    import pyarrow.parquet as pq
+    os.makedirs(dir_result_cache, exist_ok=True)
+    tmp_path = cache_path + '.tmp'
+    schema = get_parquet_schema(discrepancy_columns)
+    rows = iter(rows)
+    try:
+        with pq.ParquetWriter(tmp_path, schema) as writer:
+            while True:
+                batch = list(itertools.islice(rows, batchsize))
+                if not batch:
+                    break
+                writer.write_table(rows_to_parquet_table(batch, schema))
+                yield from batch
+        os.replace(tmp_path, cache_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    evict_result_cache(args.result_cache_entries)
+
+
+def evict_result_cache(max_entries):
+    # Tiene solo le max_entries voci usate più di recente
+    entries = sorted((os.stat(path).st_mtime, path) for path in
+                     (os.path.join(dir_result_cache, name) for name in os.listdir(dir_result_cache))
+                     if path.endswith('.parquet'))
+    for _, path in entries[:-max_entries]:
+        os.remove(path)
+        if args.verbose:
+            print("Cache confronto: rimosso {}".format(path))
 # endregion
-# Per ogni voce nell'invetario, calcola la giacenza a quella data e confronta
-calc_discrepancy()
+
+# end region
+# region Servizio
+# Modalità --daemon: un solo thread esegue importazioni e confronti (SQLite e Odin restano su quel thread),
+# l'API HTTP locale accoda le richieste e legge l'ultimo risultato tenuto in memoria.
+daemon_state = {'in_corso': False, 'ultimo_confronto': None, 'durata_s': None, 'righe': None, 'errore': None}
+daemon_result = None
+daemon_requests = queue.Queue()
+
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+    def send_json(self, status, payload):
+        body = json.dumps(payload, default=str).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/status':
+            self.send_json(200, daemon_state)
+        elif self.path == '/risultato':
+            if daemon_result is None:
+                self.send_json(404, {'errore': "Nessun confronto ancora eseguito."})
+            else:
+                self.send_json(200, json.loads(daemon_result.to_json(orient='records', date_format='iso')))
+        else:
+            self.send_json(404, {'errore': "Percorsi: GET /status, GET /risultato, POST /run"})
+
+    def do_POST(self):
+        if self.path != '/run':
+            self.send_json(404, {'errore': "Percorsi: GET /status, GET /risultato, POST /run"})
+            return
+        future = Future()
+        daemon_requests.put(future)
+        self.send_json(200, future.result())
+
+    def log_message(self, format, *args_):
+        if args.verbose:
+            super().log_message(format, *args_)
+
+
+def run_daemon_cycle():
+    global daemon_result
+    daemon_state['in_corso'] = True
+    started = time.perf_counter()
+    reset_metrics()
+    try:
+        ensure_odin_alive()
+        daemon_result = run_pipeline()
+        daemon_state.update(righe=len(daemon_result), errore=None)
+    except (Exception, SystemExit) as e:
+        # Un errore (anche un exit() delle funzioni di importazione) non deve fermare il servizio
+        daemon_state['errore'] = repr(e)
+        print("Errore durante il confronto: {!r}".format(e))
+    finally:
+        daemon_state.update(in_corso=False, ultimo_confronto=datetime.now().isoformat(timespec='seconds'),
+                            durata_s=round(time.perf_counter() - started, 3))
+        if args.metrics_json:
+            write_metrics(args.metrics_json)
+    return dict(daemon_state)
+
+
+def run_daemon():
+    server = ThreadingHTTPServer(('127.0.0.1', args.daemon_port), DaemonRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print("Servizio in ascolto su http://127.0.0.1:{} (GET /status, GET /risultato, POST /run).".format(
+        args.daemon_port))
+    interval = args.daemon_interval * 60 or None
+    if interval:
+        run_daemon_cycle()
+    try:
+        while True:
+            try:
+                future = daemon_requests.get(timeout=interval)
+            except queue.Empty:
+                future = None  # Esecuzione pianificata
+            summary = run_daemon_cycle()
+            if future is not None:
+                future.set_result(summary)
+            # Le richieste arrivate durante l'esecuzione ricevono lo stesso risultato
+            while not daemon_requests.empty():
+                daemon_requests.get_nowait().set_result(summary)
+    except KeyboardInterrupt:
+        print("Servizio fermato.")
+    finally:
+        server.shutdown()
+        close_odin_pool()
 # endregion
-# region Uscita
-conn_app.close()
-tunnel_odin.close()
-conn_odin.close()
-print("Importazione e confronto completati.")
+
+# region Fasi
+def run_stages(stages):
+    # stages: nome -> (dipendenze, funzione). La funzione viene chiamata sul thread principale quando le
+    # dipendenze sono completate e restituisce un iterabile di azioni; l'iterabile viene consumato in un
+    # thread dedicato (rete, pool di processi) mentre le azioni, cioè le scritture su SQLite, vengono
+    # eseguite una alla volta sul thread principale. Così le fasi indipendenti si sovrappongono e
+    # SQLite ha un solo scrittore.
+    # Per ogni fase vengono registrati durata, righe scritte e tempo passato nelle scritture.
+    # Se una fase fallisce le altre vengono fermate e i loro generatori chiusi (pool di processi, cursori
+    # non bufferizzati) prima di rilanciare l'errore: in --daemon il ciclo successivo riusa la connessione a Odin.
+    # Le fasi interrotte vengono registrate con 'interrotta': true.
+    events = queue.Queue(maxsize=16)  # Limita i blocchi già scaricati ma non ancora scritti
+    stop = threading.Event()
+    running, done = set(), set()
+    spans, pumps = {}, []
+
+    def offer(item):
+        # Come events.put, ma rinuncia se le fasi vengono fermate: la coda piena non verrebbe più svuotata
+        while not stop.is_set():
+            try:
+                events.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def pump(name, actions):
+        try:
+            for action in actions:
+                if not offer((name, action)):
+                    break
+            else:
+                offer((name, None))
+        except BaseException as e:
+            offer((name, e))
+        finally:
+            close = getattr(actions, 'close', None)
+            if close is not None:
+                close()
+
+    try:
+        while len(done) < len(stages):
+            for name, (dependencies, stage) in stages.items():
+                if name in running or name in done or not set(dependencies) <= done:
+                    continue
+                if args.sequential and running:
+                    break
+                if args.verbose:
+                    print("Avvio fase {}.".format(name))
+                running.add(name)
+                spans[name] = Span(name).start()
+                spans[name].extra = {'scritture_s': 0.0, 'scritture': 0}
+                pumps.append(threading.Thread(target=pump, args=(name, stage()), daemon=True, name=name))
+                pumps[-1].start()
+            name, item = events.get()
+            if item is None:
+                running.discard(name)
+                done.add(name)
+                spans[name].stop()  # Con --verbose stampa durata e righe della fase
+            elif isinstance(item, BaseException):
+                raise item
+            else:
+                started = time.perf_counter()
+                rows = item()
+                spans[name].extra['scritture_s'] += time.perf_counter() - started
+                spans[name].extra['scritture'] += 1
+                if isinstance(rows, int):
+                    spans[name].rows += rows
+    except BaseException:
+        stop.set()
+        for thread in pumps:
+            thread.join()
+        raise
+    finally:
+        # Le fasi interrotte da un errore vengono chiuse comunque: Span.active torna a zero e il ciclo
+        # successivo (--daemon) azzera di nuovo i picchi di memoria
+        for name in running:
+            spans[name].extra['interrotta'] = True
+            spans[name].stop()
+# endregion
+
+# region Esecuzione
+def open_connections():
+    global conn_app, cursor_app
+
+    # Connessione al database SQLite (DB app)
+    if args.reset and os.path.exists(database):
+        try:
+            os.remove(database)
+        except Exception as e:
+            print(e)
+            exit(1)
+
+    database_exists = os.path.exists(database)
+    conn_app = metered(sqlite3.connect(database), 'app')
+    cursor_app = conn_app.cursor()
+    apply_app_pragmas()
+    # La connessione al database remoto odin MariaDB viene aperta al primo utilizzo (connect_odin)
+
+    if not database_exists or args.reset:
+        init_app_db()
+    else:
+        check_app_db_schema()
+
+    if args.fast_load:
+        apply_fast_load_pragmas()
+
+
+def close_connections():
+    conn_app.close()
+    if conn_odin is not None:
+        conn_odin.close()
+        tunnel_odin.close()
+
+
+def run_imports():
+    global total_rows_odin
+    # Cache
+    total_rows_odin = 0
+
+    #region Importazioni
+    # TS e file corretti sono lavoro locale (lettura Excel), Odin e meta sono attese sul tunnel:
+    # le fasi indipendenti vengono eseguite in parallelo, i meta dopo Odin, il confronto alla fine.
+    stages = {}
+    # TS
+    if not args.skip_ts:
+        stages['ts'] = ((), lambda: xlsx_import_actions(dir_ts_file_by_date, 'ts_by_date', 'ts',
+                                                         import_df_in_ts_by_date,
+                                                         ts_file_in_range if args.date_from or args.date_to else None,
+                                                         get_ts_frame_filter()))
+    else:
+        if args.verbose:
+            print("Salto importazione file TS. (--skip-ts)")
+
+    # Odin
+    if not args.skip_odin:
+        stages['odin'] = ((), lambda: odin_sync_actions(args.odin_sync))
+    else:
+        if args.skip_odin:
+            print("Salto importazione Odin. (--skip-odin)")
+
+    # Meta
+    if not args.skip_prod_meta:
+        stages['meta'] = (('odin',) if 'odin' in stages else (), products_meta_actions)
+    else:
+        print("Salto importazione Meta Prodotti. (--skip-prod-meta)")
+
+    # Corrected
+    if not args.skip_corrected:
+        stages['corrected'] = ((), lambda: xlsx_import_actions(dir_corrected_file, 'corrected', 'corrected',
+                                                                import_df_in_corrected))
+    else:
+        if args.verbose:
+            print("Salto importazione file Corrected. (--skip-corrected)")
+
+    run_stages(stages)
+    # endregion
+
+    resolve_corrected_ids()  # Correzioni in attesa della rilevazione Odin corrispondente
+
+    # Le modifiche registrate dai trigger vengono applicate al confronto materializzato a fine importazione
+    end_odin_bulk_load()  # Caricamento massivo interrotto in un'esecuzione precedente
+    if args.rebuild_discrepancy:
+        rebuild_discrepancy()
+    elif args.engine == 'materialized':
+        refresh_discrepancy()
+
+
+def run_pipeline():
+    run_imports()
+    if args.explain:
+        explain_discrepancy()
+    # Per ogni voce nell'invetario, calcola la giacenza a quella data e confronta
+    return calc_discrepancy()
+
+
+def main():
+    profiler = start_profiling()
+    try:
+        open_connections()
+        if args.daemon:
+            run_daemon()
+        else:
+            run_imports()
+            report_discrepancy()
+
+        # region Uscita
+        close_connections()
+        print("Importazione e confronto completati.")
+        # endregion
+    finally:
+        # Profilo e metriche vengono salvati anche se l'esecuzione si interrompe
+        stop_profiling(profiler)
+        if args.metrics_json and not args.daemon:
+            write_metrics(args.metrics_json)
+
+
+if __name__ == '__main__':
+    main()
 # endregion